@@ -0,0 +1,585 @@
+"""
+update_weather.py のオフライン・ベンチマーク
+
+JMA の代わりにローカルHTTPサーバーで記録済みのチャートを返し、
+ネットワークなしで各ステージの所要時間・スループット・ピークメモリを計測する
+
+    python bench/benchmark.py                 # リポジトリに入れたフィクスチャ (bench/fixtures) で計測
+    python bench/benchmark.py --record        # 先に JMA から実データを記録し直す (要ネットワーク。差分はコミットする)
+
+フィクスチャはどの clone でも同じ結果になるよう git に入れてある。
+PNG製品は JMA から取得したそのままのファイル、PDF製品はベクターの線・文字だけで描いた
+同じページサイズの代用PDF (vector_stand_in。JMA の天気図と同じく画像を含まない) で、
+--record で取得できたものから実データに置き換わる
+    python bench/benchmark.py --json out.json # 結果をJSONでも保存
+
+シナリオ:
+    cold: キャッシュ (.cache) も出力 (images/) も空の状態から
+    warm: 直前の実行のキャッシュ・出力が残っている状態から
+    batch: 空港・火山の数を増やしたバッチ取得 (run_batch) の所要時間
+サーバー側では 404・古い Last-Modified・遅い応答を再現する (FAULTS)
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+UTC = timezone.utc
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import update_weather as uw  # noqa: E402
+
+from PIL import Image  # noqa: E402
+from pypdf import PdfReader  # noqa: E402
+
+try:
+    import resource  # ピークメモリの計測用 (Unix のみ)
+except ImportError:
+    resource = None
+
+# 記録済みチャート (bench/fixtures/<出力名>.<形式>。git に入れる)
+fixture_folder_path = os.path.join(repo_root, "bench", "fixtures")
+
+# ローカルサーバーで再現する異常系
+FAULTS = {
+    # 最新時刻のファイルが前日の Last-Modified のまま (1つ前の時刻に戻るはず)
+    "stale": ["FXFE5782_Latest.png"],
+    # 応答までの遅延秒
+    "slow": {"FSAS_Latest.png": 0.5, "FBOS39_Latest.png": 0.3},
+    # 予測より公開が遅れている製品 (最新候補が 404 になる)
+    "publish_delay": {"ASHFALL": timedelta(hours=1)},
+    # 常に 404
+    "missing": ["QMCJ_RJFK_Latest.png"],
+}
+
+# 発表時刻を並べる期間 (resolver の RESOLVE_LOOKBACK より長めに)
+ROUTE_LOOKBACK = timedelta(days=3)
+
+# バッチ取得の計測対象 (図は RJFK・桜島のフィクスチャを使い回す。火山コードはベンチ用の架空のもの)
+BATCH_AIRPORTS = [
+    "RJFK", "RJTT", "RJAA", "RJBB", "RJOO", "RJCC", "RJFF", "RJOA", "RJGG", "RJSS", "RJFT", "RJFM",
+    "RJFO", "RJFU", "RJFS", "RJKA", "RJOM", "RJOK", "RJOB", "RJNK", "RJSN", "RJCH", "RJEC", "ROAH",
+]
+BATCH_VOLCANOES = ["JR506X", "JR551X"] + [f"JR9{i:02d}X" for i in range(10)]
+BATCH_SIZES = (2, 6, 12, 24)
+
+
+# -----------------------------------
+# 1. フィクスチャ
+# -----------------------------------
+def fixture_path(chart):
+    stem = os.path.splitext(chart.output)[0]
+    return os.path.join(fixture_folder_path, f"{stem}.{chart.format}")
+
+def batch_fixture_path(chart):
+    """
+    バッチ取得の対象は group ごとにレジストリの図 (RJFK・桜島) のフィクスチャで代用する
+    """
+    if chart.group == "taf":
+        template = chart.output.split("_", 1)[0] + "_RJFK_Latest.png"
+    else:
+        template = "Sakurajima_Ashfall_Latest.png"
+    return fixture_path(uw.CHARTS_BY_OUTPUT[template])
+
+def batch_fixture_charts():
+    return uw.taf_charts(BATCH_AIRPORTS) + uw.ashfall_charts(BATCH_VOLCANOES)
+
+def record_fixtures():
+    """
+    JMA から各チャートの最新版を取得して bench/fixtures に保存する (要ネットワーク)
+    """
+    os.makedirs(fixture_folder_path, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="bench-record-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for chart in uw.CHARTS:
+            fetched = uw.fetch_chart(chart)
+            if fetched:
+                with open(fixture_path(chart), "wb") as f:
+                    f.write(fetched.content)
+                print(f"記録: {fixture_path(chart)}")
+            else:
+                print(f"記録できませんでした: {chart.output}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def vector_stand_in(chart, path, size):
+    """
+    出力PNGと同じ大きさ (RENDER_DPI で換算) のページに、緯度経度線・等値線・地点の文字を
+    ベクターで描いた代用PDFを作る (チャート名から乱数を決めるので、何度作っても同じ内容になる)
+    """
+    import random
+    from reportlab.pdfgen import canvas
+    width, height = (px * 72 / uw.RENDER_DPI for px in size)
+    rng = random.Random(chart.output)
+    can = canvas.Canvas(path, pagesize=(width, height), invariant=True)
+
+    can.setLineWidth(0.3)
+    for i in range(1, 20):
+        can.line(width * i / 20, 0, width * i / 20, height)
+        can.line(0, height * i / 20, width, height * i / 20)
+
+    # 等値線 (ランダムウォークの折れ線)
+    can.setLineWidth(0.8)
+    for _ in range(120):
+        x, y = rng.uniform(0, width), rng.uniform(0, height)
+        line = can.beginPath()
+        line.moveTo(x, y)
+        for _ in range(60):
+            x = min(max(x + rng.uniform(-8, 8), 0), width)
+            y = min(max(y + rng.uniform(-8, 8), 0), height)
+            line.lineTo(x, y)
+        can.drawPath(line)
+
+    # 地点の記号と数値
+    can.setFont("Helvetica", 5)
+    for _ in range(600):
+        x, y = rng.uniform(10, width - 30), rng.uniform(10, height - 10)
+        can.circle(x, y, 1.5)
+        can.drawString(x + 3, y - 2, f"{rng.randint(960, 1040)} {rng.randint(-40, 30):+d}")
+
+    can.setFont("Helvetica-Bold", 14)
+    can.drawString(20, height - 30, os.path.splitext(chart.output)[0])
+    can.showPage()
+    can.save()
+
+def synthesize_fixtures():
+    """
+    リポジトリにないチャート (レジストリに追加したばかりのものなど) のフィクスチャを images/ の出力から作る
+    (PNG製品はそのままコピー、PDF製品は同じページサイズのベクターの代用PDF)
+    """
+    os.makedirs(fixture_folder_path, exist_ok=True)
+    for chart in uw.CHARTS:
+        path = fixture_path(chart)
+        source = os.path.join(repo_root, uw.dest_folder_path, chart.output)
+        if os.path.exists(path) or not os.path.exists(source):
+            continue
+        if chart.format == "pdf":
+            with Image.open(source) as img:
+                vector_stand_in(chart, path, img.size)
+        else:
+            shutil.copy(source, path)
+        print(f"合成: {path}")
+
+
+# -----------------------------------
+# 2. JMA の代わりのローカルサーバー
+# -----------------------------------
+class Route:
+    def __init__(self, path, last_modified, delay=0.0):
+        self.path = path
+        self.last_modified = last_modified
+        self.delay = delay
+        with open(path, "rb") as f:
+            self.body = f.read()
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:16] + '"'
+
+def local_path(url):
+    # https://<host>/<path> -> /<host>/<path>
+    return "/" + url.split("://", 1)[1]
+
+def build_routes(now_utc, charts=None, fixture_for=fixture_path):
+    """
+    各チャートのURLテンプレートから、公開済みとみなす時刻ぶんの経路を作る
+    戻り値: {パス: Route}
+    """
+    routes = {}
+    for chart in charts or uw.CHARTS:
+        fixture = fixture_for(chart)
+        if chart.output in FAULTS["missing"] or not os.path.exists(fixture):
+            continue
+        delay = FAULTS["slow"].get(chart.output, 0.0)
+        if not chart.schedule:
+            routes[local_path(chart.url)] = Route(fixture, now_utc - timedelta(hours=1), delay)
+            continue
+
+        hours, lag = uw.ISSUANCE_SCHEDULES[chart.schedule]
+        lag += FAULTS["publish_delay"].get(chart.schedule, timedelta(0))
+        latest = {}
+        t = now_utc.replace(minute=0, second=0, microsecond=0)
+        while t > now_utc - ROUTE_LOOKBACK:
+            if t.hour in hours and t + lag <= now_utc:
+                path = local_path(chart.url.format(t=t))
+                # 同じURLに上書きされる製品は、その時刻の最新の発表だけが残る
+                latest.setdefault(path, t)
+            t -= timedelta(hours=1)
+
+        newest = max(latest.values(), default=None)
+        for path, t in latest.items():
+            last_modified = t + lag
+            if chart.output in FAULTS["stale"] and t == newest:
+                last_modified -= timedelta(days=1)
+            routes[path] = Route(fixture, last_modified, delay)
+    return routes
+
+class JmaStandInHandler(BaseHTTPRequestHandler):
+    routes = {}
+    request_count = 0
+    lock = threading.Lock()
+
+    def _respond(self, send_body):
+        with self.lock:
+            type(self).request_count += 1
+        route = self.routes.get(self.path.split("?", 1)[0])
+        if route is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if route.delay:
+            time.sleep(route.delay)
+        if self.headers.get("If-None-Match") == route.etag:
+            self.send_response(304)
+            self.send_header("ETag", route.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(route.body)))
+        self.send_header("ETag", route.etag)
+        self.send_header("Last-Modified", format_datetime(route.last_modified, usegmt=True))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(route.body)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(routes):
+    JmaStandInHandler.routes = routes
+    JmaStandInHandler.request_count = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), JmaStandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def point_registry_at(base_url):
+    """
+    レジストリの全URL (とバッチ取得で使うURLの先頭部分) をローカルサーバーに向ける
+    """
+    charts = [chart._replace(url=base_url + local_path(chart.url)) for chart in uw.CHARTS]
+    uw.CHARTS[:] = charts
+    uw.CHARTS_BY_OUTPUT.clear()
+    uw.CHARTS_BY_OUTPUT.update({chart.output: chart for chart in charts})
+    uw.JMA_AIRINFO = base_url + local_path(uw.JMA_AIRINFO)
+    uw.JMA_ASHFALL = base_url + local_path(uw.JMA_ASHFALL)
+    uw.HOST_CONCURRENCY["127.0.0.1"] = max(uw.HOST_CONCURRENCY.values())
+
+
+# -----------------------------------
+# 3. 計測
+# -----------------------------------
+def reset_peak_rss():
+    # Linux では clear_refs に 5 を書くと VmHWM (ピークRSS) がリセットされる
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+def reset_pipeline_state():
+    """
+    新しいプロセスで起動したのと同じ状態にする (キャッシュはディスクから読み直す)
+    """
+    uw._http_cache = None
+    uw._output_state = None
+    uw._resolver_state = None
+    if uw._archive_db is not None:
+        uw._archive_db.close()
+        uw._archive_db = None
+    with uw._resolved_sources_lock:
+        uw._resolved_sources.clear()
+    uw.load_overlay_image.cache_clear()
+    uw.overlay_pdf_page.cache_clear()
+    uw.deployed_with_page.cache_clear()
+
+def prepare_workdir(workdir, with_images=False):
+    os.makedirs(os.path.join(workdir, uw.dest_folder_path), exist_ok=True)
+    layer = os.path.join(workdir, uw.layer_folder_path)
+    if not os.path.exists(layer):
+        os.symlink(os.path.join(repo_root, uw.layer_folder_path), layer)
+    if with_images:
+        for chart in uw.CHARTS:
+            source = os.path.join(repo_root, uw.dest_folder_path, chart.output)
+            if os.path.exists(source):
+                shutil.copy(source, os.path.join(workdir, uw.dest_folder_path, chart.output))
+
+def measure(name, scenario, fn, unit_name=None):
+    """
+    fn() を実行して所要時間・ピークメモリを記録する
+    fn の戻り値 (数値) があればスループット (単位/秒) を出す
+    """
+    reset_peak_rss()
+    start = time.perf_counter()
+    error = None
+    amount = None
+    try:
+        amount = fn()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    result = {
+        "stage": name,
+        "scenario": scenario,
+        "seconds": seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "throughput": f"{amount / seconds:.2f} {unit_name}/s" if amount and seconds > 0 else None,
+        "error": error,
+    }
+    return result
+
+def bench_stages(workdir):
+    """
+    ステージ単体 (probe / download / merge_overlay_page / pdf_to_png_and_upload / create_combined_pdf の2方式)
+    を cold → warm の順に2回ずつ計測する (処理プールは使わず、このプロセス内で実行)
+    """
+    prepare_workdir(workdir, with_images=True)
+    results = []
+    resolved = {}
+    downloaded = {}
+
+    def probe():
+        with uw._resolved_sources_lock:
+            uw._resolved_sources.clear()
+        for chart in uw.CHARTS:
+            if chart.schedule:
+                resolved[chart.output] = uw.resolve_chart_time(chart)
+        return sum(1 for chart in uw.CHARTS if chart.schedule)
+
+    def download():
+        total = 0
+        for chart in uw.CHARTS:
+            target_time = resolved.get(chart.output)
+            if chart.schedule:
+                if not target_time:
+                    continue
+                target_time = uw.previous_issuance(chart.schedule, target_time, chart.cycles_back)
+            r = uw.http_get_cached(chart.url.format(t=target_time), chart.min_bytes)
+            if r is not None and r.status_code == 200:
+                downloaded[chart.output] = r.content
+                total += len(r.content)
+        return total / (1024 * 1024)
+
+    def overlay():
+        count = 0
+        for chart in uw.CHARTS:
+            if chart.overlay and chart.output in downloaded:
+                page = PdfReader(BytesIO(downloaded[chart.output])).pages[0]
+                uw.merge_overlay_page(page, os.path.join(uw.layer_folder_path, chart.overlay))
+                count += 1
+        return count
+
+    def render():
+        count = 0
+        for chart in uw.CHARTS:
+            if chart.format == "pdf" and chart.output in downloaded:
+                if uw.pdf_to_png_and_upload(downloaded[chart.output], chart.output, chart.overlay):
+                    count += 1
+        return count
+
+    def combine_raster():
+        uw.create_combined_pdf(uw.dest_folder_path, "all_weather_charts.pdf", mode="raster")
+        return len(uw.CHARTS)
+
+    def combine_vector():
+        # 本番では PNG化の後に元PDFが残される
+        for chart in uw.CHARTS:
+            if chart.format == "pdf" and chart.output in downloaded:
+                uw.keep_chart_source(downloaded[chart.output], chart.output)
+        uw.create_combined_pdf(uw.dest_folder_path, "all_weather_charts.pdf", mode="vector")
+        return len(uw.CHARTS)
+
+    stages = [
+        ("probe", probe, "charts"),
+        ("download", download, "MB"),
+        ("merge_overlay_page", overlay, "charts"),
+        ("pdf_to_png_and_upload", render, "charts"),
+        ("create_combined_pdf:raster", combine_raster, "pages"),
+        ("create_combined_pdf:vector", combine_vector, "pages"),
+    ]
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        reset_pipeline_state()
+        for scenario in ("cold", "warm"):
+            for name, fn, unit_name in stages:
+                results.append(measure(name, scenario, fn, unit_name=unit_name))
+            uw.publish_outputs()
+            uw.save_caches()
+            reset_pipeline_state()
+    finally:
+        os.chdir(cwd)
+    return results
+
+def check_archive_round_trip(workdir):
+    """
+    アーカイブの保存 → 新しい順 N 件 → 期間 → 発表時刻 → history の書き出しが噛み合っているかを確かめる
+    (計測の前に行い、合わなければ AssertionError で止める)
+    """
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        reset_pipeline_state()
+        base = datetime.now(UTC).replace(minute=0, second=0, microsecond=0) - timedelta(hours=12)
+        times = [base + timedelta(hours=6 * i) for i in range(3)]
+        for i, valid_time in enumerate(times):
+            assert uw.archive_put("ROUNDTRIP", valid_time, uw.ARCHIVE_OUTPUT, b"issuance %d" % i)
+        uw.archive_put("OTHER", times[1], uw.ARCHIVE_OUTPUT, b"other")
+        # 同じ発表を同じ内容で保存し直しても索引は変わらない
+        assert not uw.archive_put("ROUNDTRIP", times[0], uw.ARCHIVE_OUTPUT, b"issuance 0")
+
+        last = uw.archive_last_issuances("ROUNDTRIP", 2)
+        assert [valid_time for valid_time, _ in last] == [times[2], times[1]], last
+        between = uw.archive_issuances_between("ROUNDTRIP", times[0], times[2])
+        assert [valid_time for valid_time, _ in between] == times[:2], between
+        valid_at = uw.archive_charts_valid_at(times[1])
+        assert sorted(valid_at) == ["OTHER", "ROUNDTRIP"], valid_at
+        with open(valid_at["ROUNDTRIP"], "rb") as f:
+            assert f.read() == b"issuance 1"
+
+        entries = uw.archive_history(["ROUNDTRIP"], last=3)
+        assert uw.export_archive(entries, "export") == 3
+        assert sorted(os.listdir("export")) == [f"ROUNDTRIP_{t:%Y%m%d%H%M}.png" for t in times]
+        print("アーカイブの往復確認: OK")
+    finally:
+        reset_pipeline_state()
+        os.chdir(cwd)
+
+def bench_pipeline(workdir):
+    """
+    update_weather.main() 全体を cold → warm の順に実行し、実行レポートを集める
+    続けて部分実行 (1製品の更新・結合PDFだけの作り直し・発表時刻の確認) も計測する
+    """
+    prepare_workdir(workdir)
+    results = []
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for scenario in ("cold", "warm"):
+            reset_pipeline_state()
+            requests_before = JmaStandInHandler.request_count
+            result = measure("main", scenario, lambda: uw.main([]))
+            report_path = os.path.join(workdir, uw.run_report_path)
+            if os.path.exists(report_path):
+                with open(report_path, encoding="utf-8") as f:
+                    result["run_report"] = json.load(f)
+            result["server_requests"] = JmaStandInHandler.request_count - requests_before
+            results.append(result)
+
+        for argv in (["update", "FXJP106"], ["pdf"], ["resolve"]):
+            reset_pipeline_state()
+            requests_before = JmaStandInHandler.request_count
+            result = measure("main:" + " ".join(argv), "warm", lambda: uw.main(argv))
+            result["server_requests"] = JmaStandInHandler.request_count - requests_before
+            results.append(result)
+    finally:
+        os.chdir(cwd)
+    return results
+
+def bench_batch(workdir):
+    """
+    空港・火山の数を BATCH_SIZES のように増やしながら run_batch を cold で実行する
+    (取得ステージの時間が対象の数にほぼ比例せずに済んでいるかを見る)
+    """
+    results = []
+    cwd = os.getcwd()
+    for size in BATCH_SIZES:
+        path = os.path.join(workdir, str(size))
+        prepare_workdir(path)
+        os.chdir(path)
+        try:
+            reset_pipeline_state()
+            airports, volcanoes = BATCH_AIRPORTS[:size], BATCH_VOLCANOES[:max(1, size // 2)]
+            requests_before = JmaStandInHandler.request_count
+            with uw.render_pool():
+                result = measure(f"batch:{size}+{len(volcanoes)}", "cold",
+                                 lambda: len(uw.run_batch(airports, volcanoes)), unit_name="charts")
+            with open(uw.run_report_path, encoding="utf-8") as f:
+                result["run_report"] = json.load(f)
+            result["server_requests"] = JmaStandInHandler.request_count - requests_before
+            results.append(result)
+        finally:
+            os.chdir(cwd)
+    return results
+
+def print_results(results):
+    print("--- ベンチマーク結果 ---")
+    print(f"{'stage':<28}{'scenario':<10}{'seconds':>9}{'peak MB':>9}  throughput")
+    for r in results:
+        peak = f"{r['peak_rss_mb']:.0f}" if r["peak_rss_mb"] is not None else "-"
+        note = r["error"] or r["throughput"] or "-"
+        print(f"{r['stage']:<28}{r['scenario']:<10}{r['seconds']:>9.2f}{peak:>9}  {note}")
+        report = r.get("run_report")
+        if report:
+            stages = " / ".join(f"{name} {seconds:.2f}s" for name, seconds in report["stages"].items())
+            print(f"{'':<38}{stages} (requests {r['server_requests']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--record", action="store_true", help="JMA から実データを記録し直す (要ネットワーク)")
+    parser.add_argument("--json", help="結果を保存するJSONファイル")
+    parser.add_argument("--keep", action="store_true", help="作業フォルダを削除しない")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixtures()
+    synthesize_fixtures()
+
+    now_utc = datetime.now(UTC)
+    routes = build_routes(now_utc)
+    routes.update(build_routes(now_utc, batch_fixture_charts(), batch_fixture_path))
+    server = start_server(routes)
+    point_registry_at(f"http://127.0.0.1:{server.server_address[1]}")
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        check_archive_round_trip(os.path.join(workdir, "archive"))
+        results = bench_stages(os.path.join(workdir, "stages"))
+        results += bench_pipeline(os.path.join(workdir, "pipeline"))
+        results += bench_batch(os.path.join(workdir, "batch"))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"作業フォルダ: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+if __name__ == "__main__":
+    main()
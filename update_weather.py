@@ -1,16 +1,42 @@
-import requests
+"""
+JMA の天気図を取得して images/ に保存する
+
+    python update_weather.py                  # 全チャートを更新 (cron / GitHub Actions)
+    python update_weather.py update FXJP106   # 指定したチャートだけ更新
+    python update_weather.py pdf              # 結合PDFだけ作り直す
+    python update_weather.py resolve          # 最新の発表時刻とURLを確認するだけ
+    python update_weather.py history ASAS --last 8 --export loop/   # アーカイブの過去の発表を一覧・書き出す
+
+import しただけでは通信も重いライブラリの読み込みもしない
+(ライブラリとしては run_update / rebuild_pdfs / resolve_latest_times などを呼ぶ)
+"""
 from datetime import datetime, timedelta, timezone
 UTC = timezone.utc
-from pdf2image import convert_from_path
 import shutil
 import os
-from PIL import Image
-
-# --- 追加: PDF編集用ライブラリ ---
+import argparse
+import subprocess
+import json
+import hashlib
+import sqlite3
+import random
+import time
+import threading
+from functools import lru_cache
+from email.utils import parsedate_to_datetime # HTTPヘッダーの日付解析用
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+import multiprocessing
+try:
+    import resource  # ピークメモリの計測用 (Unix のみ)
+except ImportError:
+    resource = None
+from urllib.parse import urlparse
 from io import BytesIO
-from pypdf import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
+
+# ★追加: 重いライブラリ (requests / Pillow / NumPy / pypdf / ReportLab / pdf2image) は使う関数の中で読み込む
+# (import しただけでは読み込まず、PNG製品だけの更新ではPDF用のライブラリを読み込まない)
 
 # -----------------------------------
 # 1. 保存先フォルダの定義
@@ -18,470 +44,2551 @@ from reportlab.lib.utils import ImageReader
 
 # 保存先フォルダパス
 dest_folder_path = "images"
-os.makedirs(dest_folder_path, exist_ok=True)
-print(f"Destination folder: {dest_folder_path}")
 
 # ★追加: レイヤー画像のフォルダパス
 layer_folder_path = "layer"
 
+# ★追加: 実行間で引き継ぐキャッシュのフォルダパス (GitHub Actions では actions/cache で保存)
+cache_folder_path = ".cache"
+
+# ★追加: 過去のチャートの保存先 (git には入れない。GitHub Actions では actions/cache で保存)
+archive_folder_path = "archive"
+
+# ★追加: 実行中の出力の書き込み先 (全チャート・PDFがそろってから publish_outputs で公開先へ移す)
+staging_folder_path = ".staging"
+
 # -----------------------------------
 # ★追加: PDFにレイヤー画像を合成する関数
 # -----------------------------------
-def overlay_japan_map(pdf_path, overlay_image_name):
+@lru_cache(maxsize=None)
+def import_reportlab():
     """
-    pdf_path: 元のPDFファイルのパス
-    overlay_image_name: layerフォルダ内のPNGファイル名
-    戻り値: 合成後のPDFファイルパス（失敗時や画像がない場合は元のパスを返す）
+    ReportLab を読み込み (canvas モジュール, ImageReader) を返す (PDFを作るときだけ読み込む)
     """
-    overlay_png_path = os.path.join(layer_folder_path, overlay_image_name)
+    from reportlab import rl_config
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import ImageReader
 
-    # 元PDFやレイヤー画像が存在しない場合は何もしない
-    if not os.path.exists(pdf_path):
-        return pdf_path
-    if not os.path.exists(overlay_png_path):
-        print(f"警告: レイヤー画像なし ({overlay_png_path}) -> 合成スキップ")
-        return pdf_path
+    # 埋め込む画像を ASCII85 にしない (純Pythonのエンコードが遅く、サイズも25%増えるため)
+    rl_config.useA85 = 0
+    return canvas, ImageReader
 
-    print(f"カラー合成処理開始: {pdf_path} + {overlay_image_name}")
+@lru_cache(maxsize=None)
+def overlay_pdf_page(overlay_png_path, width, height):
+    """
+    レイヤー画像をページいっぱいに配置した透明なPDFページ
+    (同じレイヤーを使うページでは同じオブジェクトを使うので、結合PDFでも画像は1回だけ埋め込まれる)
+    """
+    from pypdf import PdfReader
+    canvas, ImageReader = import_reportlab()
+    # ReportLabで透明なPDFキャンバスを作成
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=(width, height))
 
-    try:
-        reader = PdfReader(pdf_path)
-        writer = PdfWriter()
-
-        # 全ページに対して処理
-        for page in reader.pages:
-            width = float(page.mediabox.width)
-            height = float(page.mediabox.height)
-
-            # ReportLabで透明なPDFキャンバスを作成
-            packet = BytesIO()
-            can = canvas.Canvas(packet, pagesize=(width, height))
-            
-            # 画像をページサイズいっぱいに配置 (mask='auto'で透過)
-            can.drawImage(ImageReader(overlay_png_path), 0, 0, width=width, height=height, mask="auto")
-            can.save()
-            packet.seek(0)
-            
-            # 元のページにオーバーレイPDFをマージ
-            overlay_pdf = PdfReader(packet)
-            page.merge_page(overlay_pdf.pages[0])
-            writer.add_page(page)
-
-        # 出力ファイル名を作成 (_COLOR を付与)
-        output_file = pdf_path.replace(".pdf", "_COLOR.pdf")
-        
-        with open(output_file, "wb") as f:
-            writer.write(f)
-        
-        print(f"レイヤー合成完了: {output_file}")
-        return output_file
+    # 画像をページサイズいっぱいに配置 (mask='auto'で透過)
+    can.drawImage(ImageReader(overlay_png_path), 0, 0, width=width, height=height, mask="auto")
+    can.save()
+    packet.seek(0)
+    return PdfReader(packet).pages[0]
 
-    except Exception as e:
-        print(f"合成エラー: {e} -> 元ファイルを使用します")
-        return pdf_path
-
-
-# -----------------------------------
-# 2. PDF/画像 ダウンロード関数群
-# -----------------------------------
-def download_asas_pdf(target_time):
-    yyyymm = target_time.strftime("%Y%m")
-    yyyymmddhhmm = target_time.strftime("%Y%m%d%H%M")
-    url = f"https://www.data.jma.go.jp/yoho/data/wxchart/quick/{yyyymm}/ASAS_COLOR_{yyyymmddhhmm}.pdf"
-    filename = f"ASAS_{yyyymmddhhmm}.pdf"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        print(f"{filename} をダウンロードしました")
-        return filename
-    return None
-
-def download_fsas_pdf():
-    url = "https://www.data.jma.go.jp/yoho/data/wxchart/quick/FSAS24_COLOR_ASIA.pdf"
-    filename = "FSAS24_COLOR_ASIA.pdf"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        print(f"{filename} をダウンロードしました")
-        return filename
-    return None
-
-def download_jma_nwpmap_pdf(chart_type, target_time):
-    hh = target_time.strftime("%H")
-    url = f"https://www.jma.go.jp/bosai/numericmap/data/nwpmap/{chart_type}_{hh}.pdf"
-    filename = f"{chart_type.upper()}_{target_time.strftime('%Y%m%d%H%M')}.pdf"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        print(f"{filename} をダウンロードしました")
-        return filename
-    return None
-
-def download_jma_png(url, chart_type_name):
-    local_filename = f"{chart_type_name}.png"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(local_filename, "wb") as f:
-            f.write(r.content)
-        print(f"{local_filename} をダウンロードしました")
-        return local_filename
-    return None
-
-def download_jma_hourly_png(chart_type_base, target_time):
-    hh = target_time.strftime("%H")
-    url = f"https://www.data.jma.go.jp/airinfo/data/pict/nwp/{chart_type_base}_{hh}.png"
-    filename = f"{chart_type_base.upper()}_{target_time.strftime('%Y%m%d%H%M')}.png"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        print(f"{filename} をダウンロードしました")
-        return filename
-    return None
-
-def download_jma_ashfall_pdf(chart_id, target_time_jst):
-    target_time_utc = target_time_jst.astimezone(UTC)
-    yyyymmddhhmm = target_time_utc.strftime("%Y%m%d%H%M")
-    url = f"https://www.jma.go.jp/bosai/volcano/data/ashfall/pdf/Z__C_RJTD_{yyyymmddhhmm}00_EQV_CHT_JCIashfallr_{chart_id}_N1_image.pdf"
-    filename = f"ASHFALL_{chart_id}_{yyyymmddhhmm}.pdf"
-    r = requests.get(url)
-    if r.status_code == 200:
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        if os.path.getsize(filename) < 10240:
-            os.remove(filename)
+def merge_overlay_page(page, overlay_png_path):
+    """
+    PDFのページ (pypdf) にレイヤー画像をページいっぱいに重ねる (ベクターの内容はそのまま)
+    """
+    from pypdf import Transformation
+    box = page.mediabox
+    overlay = overlay_pdf_page(overlay_png_path, float(box.width), float(box.height))
+
+    # 元のページにオーバーレイPDFをマージ (メディアボックスの原点が (0, 0) でない場合はずらす)
+    page.merge_transformed_page(overlay, Transformation().translate(float(box.left), float(box.bottom)))
+
+
+# -----------------------------------
+# ★追加: 実行メトリクス (ステージ・チャートごとの時間、通信量、キャッシュ、メモリ)
+# -----------------------------------
+# 実行ごとの計測結果 (JSON)。cron 実行間で比較できるよう GitHub Actions ではアーティファクトとして保存する
+run_report_path = os.path.join(dest_folder_path, "run_report.json")
+
+# チャートに紐づかない通信 (チャート外の処理) の記録先
+OTHER_METRICS_KEY = "(other)"
+
+class RunMetrics:
+    """
+    1回の実行の計測値を集める (取得スレッドから同時に記録してよい)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = datetime.now(UTC)
+            self._start = time.perf_counter()
+            self.stages = {}
+            self.charts = {}
+            self.worker_peak_kb = 0
+
+    @staticmethod
+    def _new_chart_entry():
+        return {
+            "probe_seconds": 0.0,
+            "fetch_seconds": 0.0,
+            "render_seconds": None,
+            "render_wait_seconds": None,
+            "requests": 0,
+            "bytes_downloaded": 0,
+            "http_status": {},
+            "retries": 0,
+            "cache": {},
+            "result": None,
+            "output_bytes": None,
+        }
+
+    def _chart(self, name):
+        if name not in self.charts:
+            self.charts[name] = self._new_chart_entry()
+        return self.charts[name]
+
+    def current_chart(self):
+        return getattr(self._local, "chart", None)
+
+    def _current(self, chart):
+        return chart or self.current_chart() or OTHER_METRICS_KEY
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def for_chart(self, name):
+        """
+        with ブロック内 (同じスレッド) の通信をこのチャートの分として記録する
+        """
+        previous = self.current_chart()
+        self._local.chart = name
+        try:
+            yield
+        finally:
+            self._local.chart = previous
+
+    @contextmanager
+    def timed(self, key, chart=None):
+        """
+        with ブロックの所要時間をチャートの key (probe_seconds / fetch_seconds) に加える
+        """
+        name = self._current(chart)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._chart(name)[key] += elapsed
+
+    def record_request(self, method, status, nbytes, chart=None):
+        with self._lock:
+            entry = self._chart(self._current(chart))
+            entry["requests"] += 1
+            entry["bytes_downloaded"] += nbytes
+            key = f"{method} {status}"
+            entry["http_status"][key] = entry["http_status"].get(key, 0) + 1
+
+    def record_retry(self, chart=None):
+        with self._lock:
+            self._chart(self._current(chart))["retries"] += 1
+
+    def record_cache(self, kind, chart=None):
+        with self._lock:
+            cache = self._chart(self._current(chart))["cache"]
+            cache[kind] = cache.get(kind, 0) + 1
+
+    def record_worker_peak(self, peak_kb):
+        """
+        処理プールの子プロセスが返したピークメモリ (KB) を記録する
+        (子プロセスは実行中・常駐中は終了しないため、RUSAGE_CHILDREN には現れない)
+        """
+        with self._lock:
+            self.worker_peak_kb = max(self.worker_peak_kb, peak_kb or 0)
+
+    def record_render_time(self, chart, seconds):
+        """
+        処理ジョブ本体の所要時間を記録する (子プロセス内で計測。プールの空き待ちを含まない)
+        """
+        with self._lock:
+            self._chart(chart)["render_seconds"] = seconds
+
+    def record_render(self, chart, wall_seconds, result):
+        """
+        処理ジョブの結果を記録する
+        wall_seconds: 投入から完了までの時間。本体の時間との差をプールの待ち時間とする
+        """
+        with self._lock:
+            entry = self._chart(chart)
+            if wall_seconds is not None and entry["render_seconds"] is not None:
+                entry["render_wait_seconds"] = max(wall_seconds - entry["render_seconds"], 0.0)
+            entry["result"] = result
+
+    def report(self, output_names=()):
+        with self._lock:
+            # レジストリの順に並べ、チャート外の記録は最後に置く
+            names = list(output_names) + [name for name in self.charts if name not in output_names]
+            charts = {
+                name: dict(self.charts[name]) if name in self.charts else self._new_chart_entry()
+                for name in names
+            }
+            stages = dict(self.stages)
+            worker_peak_kb = self.worker_peak_kb
+        for name in output_names:
+            entry = charts[name]
+            path = os.path.join(dest_folder_path, name)
+            entry["output_bytes"] = os.path.getsize(path) if os.path.exists(path) else None
+
+        # 待ち時間は並列に処理したジョブで重なるので合計せず、最も長く待ったチャートの値にする
+        totals = {
+            "probe_seconds": 0.0, "fetch_seconds": 0.0, "render_seconds": 0.0, "render_wait_max_seconds": 0.0,
+            "requests": 0, "bytes_downloaded": 0, "retries": 0, "cache": {},
+        }
+        for entry in charts.values():
+            for key in ("probe_seconds", "fetch_seconds", "render_seconds", "requests", "bytes_downloaded", "retries"):
+                totals[key] += entry[key] or 0
+            totals["render_wait_max_seconds"] = max(totals["render_wait_max_seconds"], entry["render_wait_seconds"] or 0)
+            for kind, count in entry["cache"].items():
+                totals["cache"][kind] = totals["cache"].get(kind, 0) + count
+
+        peak_rss_mb = None
+        if resource is not None:
+            # Linux の ru_maxrss は KB 単位。子プロセスは、終了済みのもの (RUSAGE_CHILDREN) と
+            # 処理プールの各ジョブが終了時に返した値 (poppler などその子プロセスを含む) の最大値
+            children_kb = max(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, worker_peak_kb)
+            peak_rss_mb = {
+                "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "children": children_kb / 1024,
+            }
+        return {
+            "started_at": self.started_at.isoformat(),
+            "total_seconds": time.perf_counter() - self._start,
+            "stages": stages,
+            "charts": charts,
+            "totals": totals,
+            "peak_rss_mb": peak_rss_mb,
+        }
+
+    def write_report(self, path=run_report_path, output_names=()):
+        report = self.report(output_names)
+        _save_json(path, report)
+        return report
+
+def print_run_summary(report):
+    print("--- 実行レポート ---")
+    print(f"{'チャート':<34}{'確認(s)':>8}{'取得(s)':>8}{'処理(s)':>8}{'通信':>5}{'再試行':>6}{'受信KB':>9}{'出力KB':>9}  結果")
+    for name, entry in report["charts"].items():
+        render = f"{entry['render_seconds']:.1f}" if entry["render_seconds"] is not None else "-"
+        output = f"{entry['output_bytes'] / 1024:.0f}" if entry["output_bytes"] is not None else "-"
+        print(
+            f"{name:<36}{entry['probe_seconds']:>8.1f}{entry['fetch_seconds']:>8.1f}{render:>8}{entry['requests']:>5}{entry['retries']:>6}"
+            f"{entry['bytes_downloaded'] / 1024:>9.0f}{output:>9}  {entry['result'] or '-'}"
+        )
+    stages = " / ".join(f"{name} {seconds:.1f}s" for name, seconds in report["stages"].items())
+    print(f"ステージ: {stages} (合計 {report['total_seconds']:.1f}s)")
+    totals = report["totals"]
+    print(
+        f"チャート合計: 確認 {totals['probe_seconds']:.1f}s / 取得 {totals['fetch_seconds']:.1f}s"
+        f" / 処理 {totals['render_seconds']:.1f}s (プール待ち 最大 {totals['render_wait_max_seconds']:.1f}s)"
+    )
+    cache = ", ".join(f"{kind}={count}" for kind, count in sorted(totals["cache"].items())) or "-"
+    print(f"通信: {totals['requests']}件 {totals['bytes_downloaded'] / (1024 * 1024):.1f}MB 再試行 {totals['retries']}件 / キャッシュ: {cache}")
+    if report["peak_rss_mb"]:
+        print(f"ピークメモリ: main {report['peak_rss_mb']['main']:.0f}MB / 子プロセス {report['peak_rss_mb']['children']:.0f}MB")
+
+run_metrics = RunMetrics()
+
+
+# -----------------------------------
+# ★追加: 共有HTTPセッション (ホスト別の同時接続数制限・タイムアウト・再試行)
+# -----------------------------------
+# 取得ステージ全体のワーカー数
+FETCH_MAX_WORKERS = 8
+
+# JMAに負荷をかけないよう、ホストごとの同時リクエスト数を制限する
+HOST_CONCURRENCY = {
+    "www.jma.go.jp": 4,
+    "www.data.jma.go.jp": 4,
+}
+DEFAULT_HOST_CONCURRENCY = 2
+
+# (接続, 読み込み) タイムアウト秒。応答の止まったホストでジョブ全体が固まらないようにする
+HTTP_TIMEOUT = (5, 20)
+
+# 5xx・接続エラー時の再試行 (指数バックオフ + ジッター)
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 8.0
+HTTP_RETRY_STATUS = {500, 502, 503, 504}
+
+# チャート本文の読み込み単位と上限 (これを超える応答は途中で打ち切る)
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+CHART_MAX_BYTES = 50 * 1024 * 1024
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def _host_semaphore(url):
+    host = urlparse(url).hostname or ""
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            limit = HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY)
+            _host_semaphores[host] = threading.BoundedSemaphore(limit)
+        return _host_semaphores[host]
+
+def get_http_session():
+    """
+    全ダウンロード関数で共有するセッション
+    ホストごとにコネクションをプールし、Keep-Aliveで再利用する
+    """
+    global _http_session
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            pool_size = max([DEFAULT_HOST_CONCURRENCY, *HOST_CONCURRENCY.values()])
+            adapter = HTTPAdapter(
+                pool_connections=len(HOST_CONCURRENCY) + 1,
+                pool_maxsize=pool_size,
+                max_retries=0,  # 再試行は http_request 側で行う
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+def http_request(method, url, read_body=None, **kwargs):
+    """
+    read_body: 指定すると本文をストリームで受け取り、ホストの枠を持ったまま read_body(応答) を呼んで
+               戻り値を応答の body に入れる (本文を丸ごと読む前に大きさを確認して打ち切れるように)
+    """
+    import requests
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    if read_body:
+        kwargs["stream"] = True
+    session = get_http_session()
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            with _host_semaphore(url):
+                r = session.request(method, url, **kwargs)
+                r.body = None
+                if read_body and r.status_code not in HTTP_RETRY_STATUS:
+                    r.body = read_body(r)
+            run_metrics.record_request(method, r.status_code, r.raw.tell() if read_body else len(r.content))
+            if r.status_code not in HTTP_RETRY_STATUS or attempt == HTTP_MAX_RETRIES:
+                if read_body and r.status_code in HTTP_RETRY_STATUS:
+                    r.close()  # 本文を読んでいないストリームの接続を残さない
+                return r
+            r.close()
+            reason = f"HTTP {r.status_code}"
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            run_metrics.record_request(method, type(e).__name__, 0)
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            reason = type(e).__name__
+
+        # 待機中はホストの枠を手放しておく
+        run_metrics.record_retry()
+        delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+        print(f"再試行 {attempt + 1}/{HTTP_MAX_RETRIES}: {url} ({reason}, {delay:.1f}秒後)")
+        time.sleep(delay)
+
+def http_get(url, **kwargs):
+    return http_request("GET", url, **kwargs)
+
+def http_head(url, **kwargs):
+    return http_request("HEAD", url, **kwargs)
+
+def chart_body_reader(min_bytes=0, max_bytes=CHART_MAX_BYTES):
+    """
+    http_request の read_body 用: 200 応答の本文をメモリに読む
+    空の図 (min_bytes 以下) や大きすぎる応答は、Content-Length の時点か読んだ量が超えた時点で打ち切って None を返す
+    """
+    def read(r):
+        if r.status_code != 200:
+            r.content  # 304・404 などの短い本文は読み切って接続をプールに戻す
+            return None
+        length = r.headers.get("Content-Length")
+        if length and not r.headers.get("Content-Encoding") and not min_bytes < int(length) <= max_bytes:
+            r.close()
+            return None
+        buffer = BytesIO()
+        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            if buffer.tell() > max_bytes:
+                r.close()
+                return None
+        if buffer.tell() <= min_bytes:
             return None
-        return filename
-    return None
+        return buffer.getvalue()
+    return read
+
 
 # -----------------------------------
-# 3. 取得ロジック関数群
+# ★追加: 条件付きGETキャッシュ (ETag / Last-Modified)
 # -----------------------------------
-def get_latest_two_pdfs():
-    now_utc = datetime.now(UTC)
-    hours = [0, 6, 12, 18]
-    for i in range(2):
-        day = now_utc - timedelta(days=i)
-        candidate_hours = hours[::-1]
-        for h in candidate_hours:
-            target_time = day.replace(hour=h, minute=0, second=0, microsecond=0)
-            latest_pdf = download_asas_pdf(target_time)
-            if latest_pdf:
-                idx = candidate_hours.index(h)
-                if idx + 1 < len(candidate_hours):
-                    prev_time = day.replace(hour=candidate_hours[idx + 1], minute=0, second=0, microsecond=0)
-                else:
-                    prev_day = day - timedelta(days=1)
-                    prev_time = prev_day.replace(hour=18, minute=0, second=0, microsecond=0)
-                prev_pdf = download_asas_pdf(prev_time)
-                return latest_pdf, prev_pdf
-    return None, None
+# URLごとに検証子(ETag / Last-Modified)と本文のハッシュを保存し、
+# 次回は If-None-Match / If-Modified-Since 付きで問い合わせる
+http_cache_dir = os.path.join(cache_folder_path, "http")
+http_cache_index_path = os.path.join(http_cache_dir, "index.json")
+http_cache_blob_dir = os.path.join(http_cache_dir, "blobs")
+
+# この期間参照されなかったURLはキャッシュから削除する (時刻入りURLが溜まり続けないように)
+HTTP_CACHE_MAX_AGE = timedelta(days=3)
+# 参照時刻 (used_at) はこれより古くなったときだけ書き換える
+# (変化のない実行で索引が変わらないようにし、Actions のキャッシュを保存し直さないため)
+HTTP_CACHE_TOUCH_INTERVAL = timedelta(days=1)
+
+# 出力PNGごとに「どの元データから作ったか」を記録し、同じなら合成・PNG化・コピーを省略する
+output_state_path = os.path.join(cache_folder_path, "outputs.json")
+
+_http_cache = None
+_output_state = None
+_cache_lock = threading.Lock()
+
+class CachedResponse:
+    """
+    http_get_cached の戻り値 (requests.Response と同じ属性名で参照できる)
+    not_modified: 前回取得時と内容が同じ (304 応答またはハッシュ一致)
+    """
+    def __init__(self, status_code, content, headers, not_modified, sha256):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.not_modified = not_modified
+        self.sha256 = sha256
+
+def _load_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _http_cache_entries():
+    global _http_cache
+    if _http_cache is None:
+        _http_cache = _load_json(http_cache_index_path)
+    return _http_cache
+
+def _blob_path(sha256):
+    return os.path.join(http_cache_blob_dir, sha256)
+
+def _touched(entry, new_entry, now_utc):
+    """
+    new_entry に参照時刻を入れる。内容が前回と同じで参照時刻が HTTP_CACHE_TOUCH_INTERVAL 以内なら前回の時刻のまま
+    """
+    used_at = entry.get("used_at")
+    same = all(entry.get(k) == v for k, v in new_entry.items())
+    if not (same and used_at and datetime.fromisoformat(used_at) > now_utc - HTTP_CACHE_TOUCH_INTERVAL):
+        used_at = now_utc.isoformat()
+    return dict(new_entry, used_at=used_at)
+
+def http_get_cached(url, min_bytes=0):
+    """
+    キャッシュ付きGET。304 の場合はキャッシュ済みの本文を返す
+    本文はストリームで読み、min_bytes 以下 (空の図)・大きすぎる応答は読み切る前に捨てる
+    戻り値: 200 系は CachedResponse、空・大きすぎる本文は None、それ以外は requests.Response
+    """
+    with _cache_lock:
+        entry = dict(_http_cache_entries().get(url, {}))
+
+    headers = {}
+    if entry and os.path.exists(_blob_path(entry["sha256"])):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    r = http_get(url, headers=headers, read_body=chart_body_reader(min_bytes))
 
-def get_latest_jma_nwpmap_pdf(chart_type):
-    now_utc = datetime.now(UTC)
-    hours_nwpmap = [0, 12]
-    for i in range(2):
-        day = now_utc - timedelta(days=i)
-        for h in sorted(hours_nwpmap, key=lambda x: abs(now_utc.hour - x)):
-            target_time = day.replace(hour=h, minute=0, second=0, microsecond=0)
-            if target_time > now_utc: continue
-            pdf_file = download_jma_nwpmap_pdf(chart_type, target_time)
-            if pdf_file: return pdf_file
-    return None
-
-def get_latest_jma_hourly_png(chart_type_base, hours_list):
     now_utc = datetime.now(UTC)
-    for i in range(2):
-        day = now_utc - timedelta(days=i)
-        candidate_hours = sorted(hours_list, key=lambda x: abs(now_utc.hour - x) if day.date() == now_utc.date() else x, reverse=True)
-        for h in candidate_hours:
-            target_time = day.replace(hour=h, minute=0, second=0, microsecond=0)
-            if target_time > now_utc: continue
-            png_file = download_jma_hourly_png(chart_type_base, target_time)
-            if png_file: return png_file
-    return None
-
-def get_latest_jma_ashfall_pdf_stable(volcano_name, volcano_code):
-    ash_hours = [2, 5, 8, 11, 14, 17, 20, 23]
-    now_utc = datetime.now(timezone.utc)
-    candidates = [h for h in ash_hours if h <= now_utc.hour]
-    if candidates:
-        base_hour = max(candidates)
-        base_day = now_utc
-    else:
-        base_hour = ash_hours[-1]
-        base_day = now_utc - timedelta(days=1)
-    idx = ash_hours.index(base_hour)
-    candidate_hours = [ash_hours[(idx - i) % len(ash_hours)] for i in range(len(ash_hours))]
-    for i in range(2):
-        day = base_day - timedelta(days=i)
-        for hh in candidate_hours:
-            ash_time = day.replace(hour=hh, minute=0, second=0, microsecond=0)
-            ts = ash_time.strftime("%Y%m%d%H%M%S")
-            url = f"https://www.jma.go.jp/bosai/volcano/data/ashfall/pdf/Z__C_RJTD_{ts}_EQV_CHT_JCIashfallr_{volcano_code}_N1_image.pdf"
-            filename = f"ASHFALL_{volcano_name}_{ts}.pdf"
-            r = requests.get(url)
-            if r.status_code == 200 and len(r.content) > 10240:
-                with open(filename, "wb") as f:
-                    f.write(r.content)
-                return filename
-    return None
+    if r.status_code == 304 and headers:
+        with open(_blob_path(entry["sha256"]), "rb") as f:
+            content = f.read()
+        with _cache_lock:
+            _http_cache_entries()[url] = _touched(entry, {k: v for k, v in entry.items() if k != "used_at"}, now_utc)
+        run_metrics.record_cache("http_not_modified")
+        return CachedResponse(200, content, r.headers, True, entry["sha256"])
+
+    if r.status_code != 200:
+        return r
+    if r.body is None:
+        print(f"空または大きすぎる応答のため破棄: {url}")
+        return None
+
+    content = r.body
+    sha256 = hashlib.sha256(content).hexdigest()
+    with _cache_lock:
+        if not os.path.exists(_blob_path(sha256)):
+            os.makedirs(http_cache_blob_dir, exist_ok=True)
+            with open(_blob_path(sha256), "wb") as f:
+                f.write(content)
+        _http_cache_entries()[url] = _touched(entry, {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "sha256": sha256,
+        }, now_utc)
+    not_modified = entry.get("sha256") == sha256
+    run_metrics.record_cache("http_same_content" if not_modified else "http_miss")
+    return CachedResponse(200, content, r.headers, not_modified, sha256)
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _output_entries():
+    global _output_state
+    if _output_state is None:
+        _output_state = _load_json(output_state_path)
+    return _output_state
+
+def output_is_current(final_drive_name, source_key):
+    """
+    出力PNGが同じ元データから作成済みかどうか
+    """
+    if not os.path.exists(current_path(os.path.join(dest_folder_path, final_drive_name))):
+        return False
+    with _cache_lock:
+        return _output_entries().get(final_drive_name) == source_key
+
+def record_output(final_drive_name, source_key):
+    with _cache_lock:
+        _output_entries()[final_drive_name] = source_key
+
+def save_caches():
+    """
+    キャッシュの索引を保存し、古いURLと参照されなくなった本文を削除する
+    """
+    with _cache_lock:
+        if _http_cache is not None:
+            expire_before = (datetime.now(UTC) - HTTP_CACHE_MAX_AGE).isoformat()
+            for url in [u for u, e in _http_cache.items() if e.get("used_at", "") < expire_before]:
+                del _http_cache[url]
+            _save_json(http_cache_index_path, _http_cache)
+            referenced = {entry["sha256"] for entry in _http_cache.values()}
+            if os.path.isdir(http_cache_blob_dir):
+                for name in os.listdir(http_cache_blob_dir):
+                    if name not in referenced:
+                        os.remove(_blob_path(name))
+        if _output_state is not None:
+            _save_json(output_state_path, _output_state)
+        if _resolver_state is not None:
+            _save_json(resolver_state_path, _resolver_state)
+
 
 # -----------------------------------
-# 4. 保存・アップロード用関数
+# ★追加: 発表スケジュールに基づく最新時刻の推定
 # -----------------------------------
-def pdf_to_png_and_upload(pdf_file, final_drive_name):
-    if pdf_file and os.path.exists(pdf_file):
-        png_filename_local = pdf_file.replace(".pdf", ".png")
-        # カラー化されたPDFの場合は高解像度で変換
-        pages = convert_from_path(pdf_file, dpi=200)
-        pages[0].save(png_filename_local, "PNG")
+# 製品ごとの発表サイクル (UTC時) と、発表時刻から公開されるまでの目安の遅れ
+ISSUANCE_SCHEDULES = {
+    "ASAS": ([0, 6, 12, 18], timedelta(hours=2)),
+    "NWPMAP": ([0, 12], timedelta(hours=3)),
+    "ASHFALL": ([2, 5, 8, 11, 14, 17, 20, 23], timedelta(minutes=30)),
+    "FXJP106": ([0, 3, 6, 9, 12, 15, 18, 21], timedelta(hours=0)),
+}
 
-        shutil.copy(png_filename_local, os.path.join(dest_folder_path, final_drive_name))
-        print(f"Copied {png_filename_local} to {os.path.join(dest_folder_path, final_drive_name)}")
-        os.remove(png_filename_local)
-        return True
-    return False
+# 遡る期間と、2回目以降に同時に確認する候補数
+RESOLVE_LOOKBACK = timedelta(days=2)
+RESOLVE_BATCH_SIZE = 3
+
+# 前回確定した発表時刻 (次回はここから探し始める)
+resolver_state_path = os.path.join(cache_folder_path, "resolved.json")
+_resolver_state = None
+
+def _resolver_entries():
+    global _resolver_state
+    if _resolver_state is None:
+        _resolver_state = _load_json(resolver_state_path)
+    return _resolver_state
+
+def issuance_candidates(product, now_utc):
+    """
+    now_utc から RESOLVE_LOOKBACK 以内の発表時刻の候補 (新しい順) と、そのうち公開済みと予測される最新時刻
+    """
+    hours, lag = ISSUANCE_SCHEDULES[product]
+    earliest = now_utc - RESOLVE_LOOKBACK
+    candidates = []
+    day = now_utc.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day + timedelta(days=1) > earliest:
+        for h in sorted(hours, reverse=True):
+            t = day.replace(hour=h)
+            if earliest <= t <= now_utc:
+                candidates.append(t)
+        day -= timedelta(days=1)
 
-def direct_png_upload(local_png_file, final_drive_name):
-    if local_png_file and os.path.exists(local_png_file):
-        shutil.copy(local_png_file, os.path.join(dest_folder_path, final_drive_name))
-        print(f"Copied {local_png_file} to {os.path.join(dest_folder_path, final_drive_name)}")
-        os.remove(local_png_file)
+    predicted = next((t for t in candidates if t + lag <= now_utc), candidates[-1])
+    return candidates, predicted
+
+def issuance_batches(product, now_utc, since=None):
+    """
+    確認する発表時刻の候補を、新しい順のバッチに分けて返す
+    1回目: 公開済みと予測される最新時刻 (前回の確定時刻の方が新しければそちら) 以降の全候補
+    2回目以降: それより古い候補を RESOLVE_BATCH_SIZE 件ずつ
+    """
+    candidates, predicted = issuance_candidates(product, now_utc)
+    floor = max(predicted, since) if since else predicted
+    first = [t for t in candidates if t >= floor]
+    rest = [t for t in candidates if t < floor]
+    return [first] + [rest[i:i + RESOLVE_BATCH_SIZE] for i in range(0, len(rest), RESOLVE_BATCH_SIZE)]
+
+def last_modified_within(max_age):
+    """
+    毎回同じURLに上書きされる図用: Last-Modified が max_age 以内なら有効とみなす
+    """
+    def check(r, url, target_time):
+        last_modified_str = r.headers.get("Last-Modified")
+        if not last_modified_str:
+            print(f"警告: Last-Modifiedヘッダーがありません ({url})")
+            return False
+        last_modified_dt = parsedate_to_datetime(last_modified_str)
+        time_diff = datetime.now(UTC) - last_modified_dt
+        if time_diff > max_age:
+            print(f"スキップ: {url} はデータが古すぎます (更新: {last_modified_dt}, 経過: {time_diff})")
+            return False
         return True
-    return False
-
-# -----------------------------------
-# 5. メイン実行ブロック
-# -----------------------------------
-
-# --- ASASチャート (合成不要) ---
-latest_asas_pdf_local, prev_asas_pdf_local = get_latest_two_pdfs()
-pdf_to_png_and_upload(latest_asas_pdf_local, "ASAS_Latest.png")
-pdf_to_png_and_upload(prev_asas_pdf_local, "ASAS_Prior.png")
-if latest_asas_pdf_local and os.path.exists(latest_asas_pdf_local): os.remove(latest_asas_pdf_local)
-if prev_asas_pdf_local and os.path.exists(prev_asas_pdf_local): os.remove(prev_asas_pdf_local)
-
-# --- FSASチャート (合成不要) ---
-fsas_pdf_local = download_fsas_pdf()
-if fsas_pdf_local:
-    pdf_to_png_and_upload(fsas_pdf_local, "FSAS_Latest.png")
-    if os.path.exists(fsas_pdf_local): os.remove(fsas_pdf_local)
-
-# --- AUPQチャート (★合成対象★) ---
-# AUPQ35
-aupq35_pdf = get_latest_jma_nwpmap_pdf('aupq35')
-if aupq35_pdf:
-    # 1. カラー合成 (戻り値は合成後のファイル名)
-    aupq35_color = overlay_japan_map(aupq35_pdf, "japan_overlay_aupq.png")
-    # 2. 合成後のPDFをPNG化して保存
-    pdf_to_png_and_upload(aupq35_color, "AUPQ35_Latest.png")
-    # 3. 不要な一時ファイルの削除
-    if os.path.exists(aupq35_pdf): os.remove(aupq35_pdf)
-    if aupq35_color != aupq35_pdf and os.path.exists(aupq35_color): os.remove(aupq35_color)
-
-# AUPQ78
-aupq78_pdf = get_latest_jma_nwpmap_pdf('aupq78')
-if aupq78_pdf:
-    aupq78_color = overlay_japan_map(aupq78_pdf, "japan_overlay_aupq.png")
-    pdf_to_png_and_upload(aupq78_color, "AUPQ78_Latest.png")
-    if os.path.exists(aupq78_pdf): os.remove(aupq78_pdf)
-    if aupq78_color != aupq78_pdf and os.path.exists(aupq78_color): os.remove(aupq78_color)
-
-# --- FXFEチャート (★合成対象★) ---
-# FXFE502
-fxfe502_pdf = get_latest_jma_nwpmap_pdf('fxfe502')
-if fxfe502_pdf:
-    fxfe502_color = overlay_japan_map(fxfe502_pdf, "japan_overlay_fxfe.png")
-    pdf_to_png_and_upload(fxfe502_color, "FXFE502_Latest.png")
-    if os.path.exists(fxfe502_pdf): os.remove(fxfe502_pdf)
-    if fxfe502_color != fxfe502_pdf and os.path.exists(fxfe502_color): os.remove(fxfe502_color)
-
-# FXFE5782
-fxfe5782_pdf = get_latest_jma_nwpmap_pdf('fxfe5782')
-if fxfe5782_pdf:
-    fxfe5782_color = overlay_japan_map(fxfe5782_pdf, "japan_overlay_fxfe.png")
-    pdf_to_png_and_upload(fxfe5782_color, "FXFE5782_Latest.png")
-    if os.path.exists(fxfe5782_pdf): os.remove(fxfe5782_pdf)
-    if fxfe5782_color != fxfe5782_pdf and os.path.exists(fxfe5782_color): os.remove(fxfe5782_color)
-
-# --- FXJPチャート (★合成対象★) ---
-# FXJP854
-fxjp854_pdf = get_latest_jma_nwpmap_pdf('fxjp854')
-if fxjp854_pdf:
-    fxjp854_color = overlay_japan_map(fxjp854_pdf, "japan_overlay_fxjp.png")
-    pdf_to_png_and_upload(fxjp854_color, "FXJP854_Latest.png")
-    if os.path.exists(fxjp854_pdf): os.remove(fxjp854_pdf)
-    if fxjp854_color != fxjp854_pdf and os.path.exists(fxjp854_color): os.remove(fxjp854_color)
-
-# ---------------------------------------------------------
-# FXJP106 (修正版: 更新日時確認ロジック)
-# URL: https://www.data.jma.go.jp/airinfo/data/pict/nwp/fxjp106_HH.png
-# ---------------------------------------------------------
-from email.utils import parsedate_to_datetime # HTTPヘッダーの日付解析用
+    return check
+
+def resolve_latest_issuance(key, product, url_for, is_valid=None):
+    """
+    発表サイクルと公開遅れから最新の発表時刻を推定し、HEADリクエストで並列に確認する
+    key: 前回の確定時刻を記録するキー
+    url_for: 発表時刻(UTC) -> URL
+    is_valid: is_valid(HEAD応答, URL, 発表時刻) で有効か判定する関数 (省略時は 200 なら有効)
+    戻り値: (発表時刻, URL)。見つからなければ (None, None)
+    """
+    import requests
+    now_utc = datetime.now(UTC)
+    with _cache_lock:
+        since_str = _resolver_entries().get(key)
+    since = datetime.fromisoformat(since_str) if since_str else None
+
+    # 確認用スレッドの通信も呼び出し元のチャートの分として記録する
+    metrics_chart = run_metrics.current_chart()
 
-def download_fxjp106_checked():
-    now_utc = datetime.now(timezone.utc)
-    
-    # 現在の時刻を基準に、直近の3時間ごとの時刻(00, 03...21)を計算
-    # 例: 10時なら09時、02時なら00時
-    base_hour = (now_utc.hour // 3) * 3
-    
-    # 最新候補から順に「過去へ」遡ってチェックする
-    # 最大4回（12時間前まで）遡れば、必ず有効な最新図が見つかるはず
-    for i in range(4):
-        # 時間計算 (24時間表記の調整)
-        target_h = (base_hour - (i * 3)) % 24
-        h_str = f"{target_h:02d}"
-        
-        url = f"https://www.data.jma.go.jp/airinfo/data/pict/nwp/fxjp106_{h_str}.png"
-        filename = f"FXJP106_temp_{h_str}.png"
-        
+    def probe(target_time):
+        url = url_for(target_time)
         try:
-            # HEADリクエストでヘッダー情報のみ取得（ファイル本体はまだ落とさない）
-            head_req = requests.head(url, timeout=10)
-            
-            if head_req.status_code == 200:
-                # Last-Modifiedヘッダー（更新日時）を取得
-                last_modified_str = head_req.headers.get('Last-Modified')
-                
-                if last_modified_str:
-                    # 文字列をdatetimeオブジェクトに変換
-                    last_modified_dt = parsedate_to_datetime(last_modified_str)
-                    
-                    # サーバーの日時と現在時刻の差を計算
-                    time_diff = now_utc - last_modified_dt
-                    
-                    # 【重要】判定ロジック
-                    # もしファイルの更新時間が「12時間以上前」なら、それは「昨日のデータ」とみなしてスキップ
-                    # (FXJP106は3時間ごとなので、正常なら数時間以内の古さのはず)
-                    if time_diff > timedelta(hours=12):
-                        print(f"スキップ: {url} はデータが古すぎます (更新: {last_modified_dt}, 経過: {time_diff})")
-                        continue
-                    
-                    # データが新しい場合のみダウンロード実行
-                    r = requests.get(url, timeout=20)
-                    if r.status_code == 200:
-                        with open(filename, "wb") as f:
-                            f.write(r.content)
-                        print(f"FXJP106 をダウンロードしました (対象時刻: {h_str}UTC, 更新: {last_modified_dt})")
-                        return filename
-                else:
-                    # Last-Modifiedがない場合は、危険なのでスキップするか、とりあえず落とす（今回はスキップ）
-                    print(f"警告: Last-Modifiedヘッダーがありません ({url})")
-                    continue
-            else:
-                # 404などの場合
-                continue
-                
-        except Exception as e:
-            print(f"FXJP106 チェックエラー ({h_str}UTC): {e}")
-            continue
+            with run_metrics.for_chart(metrics_chart):
+                r = http_head(url)
+        except requests.RequestException as e:
+            print(f"確認エラー: {url} -> {e}")
+            return False
+        if r.status_code != 200:
+            return False
+        return is_valid(r, url, target_time) if is_valid else True
+
+    for batch in issuance_batches(product, now_utc, since):
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            found = list(executor.map(probe, batch))
+        # バッチ内で確認できたもののうち最も新しい時刻を採用する
+        for target_time, ok in zip(batch, found):
+            if ok:
+                with _cache_lock:
+                    _resolver_entries()[key] = target_time.isoformat()
+                return target_time, url_for(target_time)
+    return None, None
+
+
+# -----------------------------------
+# ★追加: 履歴アーカイブ (製品・発表時刻ごとに保存し、本体は内容ハッシュで重複排除)
+# -----------------------------------
+# 索引は SQLite、本体は archive/blobs/<ハッシュ先頭2文字>/<ハッシュ>
+archive_index_path = os.path.join(archive_folder_path, "index.sqlite")
+archive_blob_dir = os.path.join(archive_folder_path, "blobs")
+
+# これより古い発表は削除する
+# (出力PNGだけで1日に約36MB。GitHub Actions のキャッシュ (リポジトリ全体で10GB) に1エントリで収まる大きさにする)
+ARCHIVE_MAX_AGE = timedelta(days=3)
+
+# 保存する種類: 取得した元データ (PDF/PNG) と、images/ に出力したPNG
+ARCHIVE_SOURCE = "source"
+ARCHIVE_OUTPUT = "output"
+# 実行時に保存する種類 (元データも残すとアーカイブがほぼ倍になるので、既定では出力PNGだけ)
+ARCHIVE_KINDS = (ARCHIVE_OUTPUT,)
 
-    print("FXJP106: 有効な（新しい）画像が見つかりませんでした")
-    return None
+_archive_db = None
+_archive_lock = threading.Lock()
 
-# 実行とアップロード
-fxjp106_png = download_fxjp106_checked()
-if fxjp106_png:
-    direct_png_upload(fxjp106_png, "FXJP106_Latest.png")
+# 今回の実行で取得したチャートの発表時刻 (出力PNGの保存用) {出力名: 発表時刻}
+_archived_valid_times = {}
 
-fbjp_png = download_jma_png("https://www.data.jma.go.jp/airinfo/data/pict/fbjp/fbjp.png", "FBJP_Latest")
-if fbjp_png: direct_png_upload(fbjp_png, "FBJP_Latest.png")
+def _archive_connection():
+    global _archive_db
+    if _archive_db is None:
+        os.makedirs(archive_folder_path, exist_ok=True)
+        db = sqlite3.connect(archive_index_path, check_same_thread=False)
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS issuances (
+                product     TEXT NOT NULL,
+                kind        TEXT NOT NULL,
+                valid_time  TEXT NOT NULL,
+                sha256      TEXT NOT NULL,
+                size        INTEGER NOT NULL,
+                url         TEXT,
+                archived_at TEXT NOT NULL,
+                PRIMARY KEY (product, kind, valid_time)
+            );
+            CREATE INDEX IF NOT EXISTS issuances_by_time ON issuances (valid_time, kind);
+        """)
+        _archive_db = db
+    return _archive_db
 
-fpos39_png = download_jma_png("https://www.data.jma.go.jp/airinfo/data/pict/low-level_sigwx/fbos39.png", "FBOS39_Latest")
-if fpos39_png: direct_png_upload(fpos39_png, "FBOS39_Latest.png")
+def _time_key(dt):
+    # UTC の ISO 形式に揃え、文字列の大小で時刻順に並ぶようにする
+    return dt.astimezone(UTC).replace(microsecond=0).isoformat()
 
-# --- QMCD / QMCJ 追加分 ---
-qmcd_png = download_jma_png("https://www.data.jma.go.jp/airinfo/data/pict/taf/QMCD98_RJFK.png", "QMCD_RJFK_Latest")
-if qmcd_png: direct_png_upload(qmcd_png, "QMCD_RJFK_Latest.png")
+def archive_blob_path(sha256):
+    return os.path.join(archive_blob_dir, sha256[:2], sha256)
 
-qmcj_png = download_jma_png("https://www.data.jma.go.jp/airinfo/data/pict/taf/QMCJ98_RJFK.png", "QMCJ_RJFK_Latest")
-if qmcj_png: direct_png_upload(qmcj_png, "QMCJ_RJFK_Latest.png")
+def archive_put(product, valid_time, kind, content, url=None, skip_if_unchanged=False):
+    """
+    product の valid_time の発表を保存する (同じ発表を同じ内容で保存済みなら何もしない)
+    skip_if_unchanged: 直前に保存したものと内容が同じなら保存しない
+                       (発表時刻のわからない固定URLの製品が毎回増えないように)
+    戻り値: 保存した場合 True
+    """
+    sha256 = hashlib.sha256(content).hexdigest()
+    with _archive_lock:
+        db = _archive_connection()
+        # キャッシュから返した前回と同じ発表で索引を書き換えない (アーカイブのキャッシュを保存し直さないように)
+        row = db.execute(
+            "SELECT sha256 FROM issuances WHERE product = ? AND kind = ? AND valid_time = ?",
+            (product, kind, _time_key(valid_time)),
+        ).fetchone()
+        if row and row[0] == sha256:
+            return False
+        if skip_if_unchanged:
+            row = db.execute(
+                "SELECT sha256 FROM issuances WHERE product = ? AND kind = ? ORDER BY valid_time DESC LIMIT 1",
+                (product, kind),
+            ).fetchone()
+            if row and row[0] == sha256:
+                return False
+
+        path = archive_blob_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO issuances VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (product, kind, _time_key(valid_time), sha256, len(content), url, _time_key(datetime.now(UTC))),
+            )
+    return True
+
+def archive_last_issuances(product, n=10, kind=ARCHIVE_OUTPUT):
+    """
+    product の新しい順に n 件の発表を返す: [(発表時刻, ファイルパス), ...]
+    """
+    with _archive_lock:
+        rows = _archive_connection().execute(
+            "SELECT valid_time, sha256 FROM issuances WHERE product = ? AND kind = ? ORDER BY valid_time DESC LIMIT ?",
+            (product, kind, n),
+        ).fetchall()
+    return [(datetime.fromisoformat(t), archive_blob_path(sha256)) for t, sha256 in rows]
+
+def archive_issuances_between(product, start, end, kind=ARCHIVE_OUTPUT):
+    """
+    product の start 以上 end 未満の発表を古い順に返す: [(発表時刻, ファイルパス), ...]
+    """
+    with _archive_lock:
+        rows = _archive_connection().execute(
+            "SELECT valid_time, sha256 FROM issuances "
+            "WHERE product = ? AND kind = ? AND valid_time >= ? AND valid_time < ? ORDER BY valid_time",
+            (product, kind, _time_key(start), _time_key(end)),
+        ).fetchall()
+    return [(datetime.fromisoformat(t), archive_blob_path(sha256)) for t, sha256 in rows]
+
+def archive_charts_valid_at(valid_time, kind=ARCHIVE_OUTPUT):
+    """
+    valid_time の発表をすべての製品について返す: {製品名: ファイルパス}
+    """
+    with _archive_lock:
+        rows = _archive_connection().execute(
+            "SELECT product, sha256 FROM issuances WHERE valid_time = ? AND kind = ?",
+            (_time_key(valid_time), kind),
+        ).fetchall()
+    return {product: archive_blob_path(sha256) for product, sha256 in rows}
 
-# --- 降灰予報図 (合成不要) ---
-sakurajima_pdf = get_latest_jma_ashfall_pdf_stable("Sakurajima", "JR506X")
-if sakurajima_pdf:
-    pdf_to_png_and_upload(sakurajima_pdf, "Sakurajima_Ashfall_Latest.png")
-    os.remove(sakurajima_pdf)
+def prune_archive(max_age=ARCHIVE_MAX_AGE):
+    """
+    max_age より古い発表を削除し、どこからも参照されなくなった本体を消す
+    """
+    with _archive_lock:
+        if not os.path.exists(archive_index_path):
+            return
+        db = _archive_connection()
+        with db:
+            db.execute("DELETE FROM issuances WHERE valid_time < ?", (_time_key(datetime.now(UTC) - max_age),))
+        referenced = {row[0] for row in db.execute("SELECT DISTINCT sha256 FROM issuances")}
+        if os.path.isdir(archive_blob_dir):
+            for prefix in os.listdir(archive_blob_dir):
+                for name in os.listdir(os.path.join(archive_blob_dir, prefix)):
+                    if name not in referenced and not name.endswith(".tmp"):
+                        os.remove(os.path.join(archive_blob_dir, prefix, name))
 
-kirishima_pdf = get_latest_jma_ashfall_pdf_stable("Kirishimayama", "JR551X")
-if kirishima_pdf:
-    pdf_to_png_and_upload(kirishima_pdf, "Kirishimayama_Ashfall_Latest.png")
-    os.remove(kirishima_pdf)
 
 # -----------------------------------
-# 6. 全画像を1つのPDFにまとめる処理 (印刷品質重視・限界挑戦版)
+# 2. チャート定義 (レジストリ)
 # -----------------------------------
-def create_combined_pdf(image_folder, output_pdf_name):
-    target_images = [
-        "ASAS_Prior.png", "ASAS_Latest.png", "FSAS_Latest.png",
-        "AUPQ35_Latest.png", "AUPQ78_Latest.png",
-        "FXFE502_Latest.png", "FXFE5782_Latest.png",
-        "FBJP_Latest.png", "FBOS39_Latest.png",
-        "FXJP106_Latest.png", "FXJP854_Latest.png",
-        "QMCD_RJFK_Latest.png",
-        "QMCJ_RJFK_Latest.png",
-        "Sakurajima_Ashfall_Latest.png", "Kirishimayama_Ashfall_Latest.png"
-    ]
+# output:      images/ に保存するファイル名 (この表の順がPDFのページ順)
+# url:         URLテンプレート ({t} は発表時刻UTC。例: {t:%H})
+# schedule:    ISSUANCE_SCHEDULES の製品名 (None なら固定URL)
+# format:      "pdf" / "png"
+# overlay:     layer フォルダの合成レイヤー画像 (None なら合成なし)
+# cycles_back: 最新から何サイクル前を取得するか (ASAS_Prior 用)
+# max_age:     同じURLに上書きされる図で、Last-Modified がこれより古ければ未更新とみなす
+# min_bytes:   これ以下のサイズは空の図とみなす
+# diff_mask:   前回との差分で無視する領域 (発表時刻などの見出し)。画像サイズに対する割合 (左, 上, 右, 下) のタプル
+# group:       空港別・火山別のように同じ製品を対象ごとに取るチャートのまとまり
+#              発表時刻の推定をまとめて1回で済ませ、まとまりごとの結合PDF (images/<group>_charts.pdf) も作る
+# index_order: index.html の表示順 (PDFのページ順とは別。None のチャートは番号のあるものの後にこの表の順で並ぶ)
+Chart = namedtuple(
+    "Chart",
+    ["output", "url", "schedule", "format", "overlay", "cycles_back", "max_age", "min_bytes", "diff_mask", "group",
+     "index_order"],
+    defaults=(None, 0, None, 0, (), None, None),
+)
 
-    # A4 300DPI (印刷品質基準)
-    A4_PORTRAIT_PX = (2480, 3508)
-    A4_LANDSCAPE_PX = (3508, 2480)
-    
-    pdf_pages = []
-    print("--- A4高画質PDF結合開始 (300DPI・高品質設定) ---")
+JMA_WXCHART = "https://www.data.jma.go.jp/yoho/data/wxchart/quick/"
+JMA_NWPMAP = "https://www.jma.go.jp/bosai/numericmap/data/nwpmap/"
+JMA_AIRINFO = "https://www.data.jma.go.jp/airinfo/data/pict/"
+JMA_ASHFALL = "https://www.jma.go.jp/bosai/volcano/data/ashfall/pdf/Z__C_RJTD_{t:%Y%m%d%H%M%S}_EQV_CHT_JCIashfallr_"
 
-    for img_name in target_images:
-        img_path = os.path.join(image_folder, img_name)
-        if os.path.exists(img_path):
-            try:
-                img = Image.open(img_path).convert("RGB")
-                w, h = img.size
-                page_size = A4_LANDSCAPE_PX if w >= h else A4_PORTRAIT_PX
-
-                img_ratio = w / h
-                page_ratio = page_size[0] / page_size[1]
-
-                if img_ratio > page_ratio:
-                    new_w = page_size[0]
-                    new_h = int(new_w / img_ratio)
-                else:
-                    new_h = page_size[1]
-                    new_w = int(new_h * img_ratio)
-
-                resized_img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                canvas = Image.new("RGB", page_size, (255, 255, 255))
-                offset = ((page_size[0] - new_w) // 2, (page_size[1] - new_h) // 2)
-                canvas.paste(resized_img, offset)
-                
-                pdf_pages.append(canvas)
-            except Exception as e:
-                print(f"エラー: {img_name} -> {e}")
-
-    if pdf_pages:
-        output_path = os.path.join(image_folder, "all_weather_charts.pdf")
-        # 保存設定をギリギリまで調整
-        pdf_pages[0].save(
-            output_path, 
-            save_all=True, 
-            append_images=pdf_pages[1:],
-            resolution=300.0,
-            quality=85,           # 85はサイズ効率が非常に高いです
-            subsampling=0,        # 色のにじみを防止
-            optimize=True         # 圧縮の最適化を有効化
+ASAS_URL = JMA_WXCHART + "{t:%Y%m}/ASAS_COLOR_{t:%Y%m%d%H%M}.pdf"
+
+# nwpmap・FXJP106 は時刻ごとに同じURLへ上書きされるため、Last-Modified の新しさで判定する
+NWPMAP_MAX_AGE = timedelta(hours=18)
+FXJP106_MAX_AGE = timedelta(hours=12)
+ASHFALL_MIN_BYTES = 10240
+
+# 差分で無視する見出し (製品名・発表時刻の枠)
+ASAS_DIFF_MASK = ((0.02, 0.03, 0.17, 0.12), (0.83, 0.88, 0.98, 0.97))   # 左上・右下の枠
+NWPMAP_DIFF_MASK = ((0.0, 0.95, 0.6, 1.0),)                            # 下端の製品名・初期時刻
+FBJP_DIFF_MASK = ((0.0, 0.0, 0.23, 0.13),)
+FBOS39_DIFF_MASK = ((0.0, 0.9, 0.3, 1.0),)
+FXJP106_DIFF_MASK = ((0.8, 0.04, 0.98, 0.15), (0.8, 0.53, 0.98, 0.64))  # 上下2枚それぞれの右上の枠
+QMC_DIFF_MASK = ((0.65, 0.03, 0.98, 0.08),)                            # 右上の ISSUED TIME
+ASHFALL_DIFF_MASK = ((0.6, 0.04, 0.97, 0.08),)                         # 右上の発表時刻
+
+# 空港別 (ICAO) の TAF 時系列図 (QMCD98: Part1 / QMCJ98: Part2)
+TAF_AIRPORTS = ["RJFK"]
+# 火山別の降灰予報 (定時) {JMA の火山コード: 出力名}。ここにない火山はコードを出力名に使う
+VOLCANO_NAMES = {
+    "JR506X": "Sakurajima",
+    "JR551X": "Kirishimayama",
+}
+ASHFALL_VOLCANOES = ["JR506X", "JR551X"]
+
+def taf_charts(icao_codes):
+    charts = []
+    for icao in icao_codes:
+        icao = icao.upper()
+        for product in ("QMCD", "QMCJ"):
+            charts.append(Chart(
+                f"{product}_{icao}_Latest.png", JMA_AIRINFO + f"taf/{product}98_{icao}.png", None, "png",
+                diff_mask=QMC_DIFF_MASK, group="taf",
+            ))
+    return charts
+
+def ashfall_charts(volcano_codes):
+    return [
+        Chart(
+            f"{VOLCANO_NAMES.get(code, code)}_Ashfall_Latest.png", JMA_ASHFALL + f"{code}_N1_image.pdf", "ASHFALL", "pdf",
+            min_bytes=ASHFALL_MIN_BYTES, diff_mask=ASHFALL_DIFF_MASK, group="ashfall",
         )
-        file_size_mb = os.path.getsize(output_path) / (1024 * 1024)
-        print(f"PDF作成完了: {output_path} (サイズ: {file_size_mb:.2f} MB)")
-        
-        # もしこれでも25MBを超えた場合の警告
-        if file_size_mb > 25:
-            print("【警告】ファイルサイズが25MBを超えています。Cloudflare Pagesでの公開に失敗する可能性があります。")
+        for code in (code.upper() for code in volcano_codes)
+    ]
+
+CHARTS = [
+    # --- ASAS / FSAS チャート (合成不要) ---
+    Chart("ASAS_Prior.png", ASAS_URL, "ASAS", "pdf", cycles_back=1, diff_mask=ASAS_DIFF_MASK, index_order=1),
+    Chart("ASAS_Latest.png", ASAS_URL, "ASAS", "pdf", diff_mask=ASAS_DIFF_MASK, index_order=4),
+    Chart("FSAS_Latest.png", JMA_WXCHART + "FSAS24_COLOR_ASIA.pdf", None, "pdf", diff_mask=ASAS_DIFF_MASK, index_order=5),
+    # --- AUPQ / FXFE チャート (★合成対象★) ---
+    Chart("AUPQ35_Latest.png", JMA_NWPMAP + "aupq35_{t:%H}.pdf", "NWPMAP", "pdf", "japan_overlay_aupq.png", max_age=NWPMAP_MAX_AGE, diff_mask=NWPMAP_DIFF_MASK, index_order=2),
+    Chart("AUPQ78_Latest.png", JMA_NWPMAP + "aupq78_{t:%H}.pdf", "NWPMAP", "pdf", "japan_overlay_aupq.png", max_age=NWPMAP_MAX_AGE, diff_mask=NWPMAP_DIFF_MASK, index_order=3),
+    Chart("FXFE502_Latest.png", JMA_NWPMAP + "fxfe502_{t:%H}.pdf", "NWPMAP", "pdf", "japan_overlay_fxfe.png", max_age=NWPMAP_MAX_AGE, diff_mask=NWPMAP_DIFF_MASK, index_order=6),
+    Chart("FXFE5782_Latest.png", JMA_NWPMAP + "fxfe5782_{t:%H}.pdf", "NWPMAP", "pdf", "japan_overlay_fxfe.png", max_age=NWPMAP_MAX_AGE, diff_mask=NWPMAP_DIFF_MASK, index_order=7),
+    # --- 航空気象 PNG ---
+    Chart("FBJP_Latest.png", JMA_AIRINFO + "fbjp/fbjp.png", None, "png", diff_mask=FBJP_DIFF_MASK, index_order=10),
+    Chart("FBOS39_Latest.png", JMA_AIRINFO + "low-level_sigwx/fbos39.png", None, "png", diff_mask=FBOS39_DIFF_MASK, index_order=11),
+    Chart("FXJP106_Latest.png", JMA_AIRINFO + "nwp/fxjp106_{t:%H}.png", "FXJP106", "png", max_age=FXJP106_MAX_AGE, diff_mask=FXJP106_DIFF_MASK, index_order=9),
+    # --- FXJPチャート (★合成対象★) ---
+    Chart("FXJP854_Latest.png", JMA_NWPMAP + "fxjp854_{t:%H}.pdf", "NWPMAP", "pdf", "japan_overlay_fxjp.png", max_age=NWPMAP_MAX_AGE, diff_mask=NWPMAP_DIFF_MASK, index_order=8),
+    # --- QMCD / QMCJ (TAF_AIRPORTS の空港ごと) ---
+    *taf_charts(TAF_AIRPORTS),
+    # --- 降灰予報図 (合成不要。ASHFALL_VOLCANOES の火山ごと) ---
+    *ashfall_charts(ASHFALL_VOLCANOES),
+]
+
+CHARTS_BY_OUTPUT = {chart.output: chart for chart in CHARTS}
+
+def register_charts(charts):
+    """
+    レジストリ (CHARTS) 外のチャート (バッチ取得の対象) も出力名で引けるようにする
+    """
+    for chart in charts:
+        CHARTS_BY_OUTPUT.setdefault(chart.output, chart)
+    return charts
+
+def chart_product(chart):
+    """
+    アーカイブ上の製品名 (ASAS_Latest / ASAS_Prior はどちらも "ASAS")
+    """
+    stem = os.path.splitext(chart.output)[0]
+    for suffix in ("_Latest", "_Prior"):
+        if stem.endswith(suffix):
+            return stem[:-len(suffix)]
+    return stem
+
+
+# -----------------------------------
+# 3. 取得ロジック関数群
+# -----------------------------------
+# 同じ取得元 (ASAS_Latest / ASAS_Prior など) の発表時刻の推定は1回の実行で1回だけ行う
+_resolved_sources = {}
+_resolved_sources_lock = threading.Lock()
+
+def content_length_above(min_bytes):
+    """
+    Content-Length がわかる場合は、空の図 (min_bytes 以下) をGETせずに除外する
+    """
+    def check(r, url, target_time):
+        length = r.headers.get("Content-Length")
+        return not length or int(length) > min_bytes
+    return check
+
+def chart_validator(chart):
+    checks = []
+    if chart.max_age:
+        checks.append(last_modified_within(chart.max_age))
+    if chart.min_bytes:
+        checks.append(content_length_above(chart.min_bytes))
+    if not checks:
+        return None
+    return lambda r, url, target_time: all(check(r, url, target_time) for check in checks)
+
+def previous_issuance(product, target_time, cycles_back):
+    hours = ISSUANCE_SCHEDULES[product][0]
+    for _ in range(cycles_back):
+        target_time -= timedelta(hours=1)
+        while target_time.hour not in hours:
+            target_time -= timedelta(hours=1)
+    return target_time
+
+def resolver_key(chart, shared=True):
+    """
+    発表時刻の推定結果のキー (_resolved_sources と resolved.json で使う)
+    shared: group のあるチャートは group と発表サイクルのキーを共有する
+    """
+    if shared and chart.group:
+        return f"group:{chart.group}:{chart.schedule}"
+    return chart.url
+
+def resolve_chart_time(chart, shared=True):
+    """
+    チャートの最新発表時刻 (UTC) を返す。見つからなければ None
+    shared: group のあるチャートは、group 内で最初に推定したチャートの結果を全員で使う
+            (同じ製品の対象ごとの図は同時に発表されるため、対象の数だけ候補を確認しない)
+            ただし共有できるのは公開済みと予測される最新時刻 (以降) が見つかった場合だけで、
+            それより古い時刻しか見つからなければ、このチャートだけで推定し直す
+            (最初に確認した対象に最近の発表がないと、他の対象まで古い図を取ってしまうため)
+    """
+    key = resolver_key(chart, shared)
+    with _resolved_sources_lock:
+        slot = _resolved_sources.setdefault(key, {"lock": threading.Lock()})
+    with slot["lock"]:
+        if "time" not in slot:
+            slot["time"], _ = resolve_latest_issuance(
+                key, chart.schedule,
+                lambda t: chart.url.format(t=t),
+                chart_validator(chart),
+            )
+        target_time = slot["time"]
+    if shared and chart.group:
+        _, predicted = issuance_candidates(chart.schedule, datetime.now(UTC))
+        if target_time is None or target_time < predicted:
+            return resolve_chart_time(chart, shared=False)
+    return target_time
+
+# 取得したチャート (name: ログ用の名前、content: 本文のバイト列、sha256: 本文のハッシュ)
+FetchedChart = namedtuple("FetchedChart", ["name", "content", "sha256"])
+
+def fetch_chart(chart):
+    """
+    レジストリの1チャートを取得し、本文をメモリに持った FetchedChart を返す (作業フォルダには書かない)
+    取得できなければ None
+    """
+    target_time = None
+    if chart.schedule:
+        with run_metrics.timed("probe_seconds"):
+            target_time = resolve_chart_time(chart)
+        if not target_time:
+            print(f"{chart.output}: 有効な（新しい）データが見つかりませんでした")
+            return None
+        target_time = previous_issuance(chart.schedule, target_time, chart.cycles_back)
+
+    url = chart.url.format(t=target_time)
+    with run_metrics.timed("fetch_seconds"):
+        r = http_get_cached(url, chart.min_bytes)
+    if (r is None or r.status_code != 200) and chart.schedule and chart.group:
+        # group で共有した発表時刻にこの対象の図がなければ、この対象だけで推定し直す
+        with run_metrics.timed("probe_seconds"):
+            own_time = resolve_chart_time(chart, shared=False)
+        if own_time and own_time != target_time:
+            target_time = previous_issuance(chart.schedule, own_time, chart.cycles_back)
+            url = chart.url.format(t=target_time)
+            with run_metrics.timed("fetch_seconds"):
+                r = http_get_cached(url, chart.min_bytes)
+    if r is None or r.status_code != 200:
+        return None
+
+    stem = os.path.splitext(chart.output)[0]
+    if target_time:
+        name = f"{stem}_{target_time.strftime('%Y%m%d%H%M')}.{chart.format}"
     else:
-        print("作成対象の画像が見つかりませんでした。")
+        name = f"{stem}.{chart.format}"
+    print(f"{name} をダウンロードしました ({len(r.content)} bytes)")
+    archive_fetched(chart, target_time or source_valid_time(r), r.content, url)
+    return FetchedChart(name, r.content, r.sha256)
+
+def source_valid_time(r):
+    """
+    発表サイクルのない製品の時刻: Last-Modified (なければ取得時刻)
+    """
+    last_modified_str = r.headers.get("Last-Modified")
+    if last_modified_str:
+        try:
+            return parsedate_to_datetime(last_modified_str)
+        except (TypeError, ValueError):
+            pass
+    return datetime.now(UTC).replace(second=0, microsecond=0)
+
+def archive_fetched(chart, valid_time, content, url):
+    with _archive_lock:
+        _archived_valid_times[chart.output] = valid_time
+    if ARCHIVE_SOURCE not in ARCHIVE_KINDS:
+        return
+    try:
+        archive_put(chart_product(chart), valid_time, ARCHIVE_SOURCE, content, url,
+                    skip_if_unchanged=not chart.schedule)
+    except (OSError, sqlite3.Error) as e:
+        print(f"アーカイブ保存エラー: {chart.output} -> {e}")
+
+def archive_outputs(outputs):
+    """
+    今回更新した出力PNGを、取得時の発表時刻でアーカイブに保存する
+    """
+    if ARCHIVE_OUTPUT not in ARCHIVE_KINDS:
+        return
+    for output in outputs:
+        with _archive_lock:
+            valid_time = _archived_valid_times.pop(output, None)
+        path = current_path(os.path.join(dest_folder_path, output))
+        if valid_time is None or not os.path.exists(path):
+            continue
+        chart = CHARTS_BY_OUTPUT[output]
+        try:
+            with open(path, "rb") as f:
+                archive_put(chart_product(chart), valid_time, ARCHIVE_OUTPUT, f.read(),
+                            skip_if_unchanged=not chart.schedule)
+        except (OSError, sqlite3.Error) as e:
+            print(f"アーカイブ保存エラー: {output} -> {e}")
+
+# -----------------------------------
+# ★追加: ステージングと公開 (実行中の出力を最後にまとめて公開先へ移す)
+# -----------------------------------
+# 出力 (PNG・縮小版・タイル・差分画像・元PDF・結合PDF) は staging_folder_path の下に同じ相対パスで書き、
+# 全部そろってから公開先へ移す。途中で失敗した実行の出力は公開先に出ず、書きかけのファイルも見えない
+# ただし移すのはファイルごとの os.replace なので、移している短い間に images/ を読むと新旧のチャートが混ざりうる
+# (index.html は最後に書き換える。実際のサイトは git のコミットから作るので、公開されるのはコミット単位の状態)
+
+def staged_path(path):
+    """
+    path (作業フォルダからの相対パス) の代わりに書き込むステージングのパス
+    """
+    return os.path.join(staging_folder_path, path)
+
+def current_path(path):
+    """
+    今回の実行で書いたものがあればステージングのパス、なければ公開中のパス
+    """
+    staged = staged_path(path)
+    return staged if os.path.exists(staged) else path
+
+def clear_staging():
+    """
+    前回の実行が途中で止まって残ったステージングを捨てる
+    """
+    if os.path.isdir(staging_folder_path):
+        shutil.rmtree(staging_folder_path)
+
+def replace_directory(src, dest):
+    """
+    dest のフォルダを src で丸ごと置き換える (古いフォルダは退避してから消す)
+    """
+    old = dest + ".old"
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    if os.path.isdir(dest):
+        os.rename(dest, old)
+    os.rename(src, dest)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+def publish_outputs():
+    """
+    ステージングの内容を公開先へ移す (ファイルは os.replace、タイルのフォルダはフォルダごと入れ替える)
+    タイルのフォルダは同じフォルダの .dzi より先に入れ替える (新しい .dzi が古いタイルを指さないように)
+    戻り値: 公開したファイル・フォルダの数
+    """
+    if not os.path.isdir(staging_folder_path):
+        return 0
+    count = 0
+    for root, dirs, files in os.walk(staging_folder_path):
+        dest_root = os.path.relpath(root, staging_folder_path)
+        os.makedirs(dest_root, exist_ok=True)
+        if os.path.basename(root) == tiles_folder_name:
+            for name in [d for d in dirs if d.endswith("_files")]:
+                dirs.remove(name)
+                replace_directory(os.path.join(root, name), os.path.join(dest_root, name))
+                count += 1
+        for name in files:
+            os.replace(os.path.join(root, name), os.path.join(dest_root, name))
+            count += 1
+    shutil.rmtree(staging_folder_path)
+    return count
+
+@lru_cache(maxsize=None)
+def deployed_with_page(folder):
+    """
+    folder (images/tiles など) が公開されるサイトに含まれるか
+    サイトは git のリポジトリから公開されるので、.gitignore で除外したフォルダは含まれない
+    (git の作業ツリーでなければ images/ をそのまま配信するものとして含まれるとみなす)
+    """
+    try:
+        result = subprocess.run(["git", "check-ignore", "-q", os.path.join(folder, "")], capture_output=True)
+    except OSError:
+        return True
+    # 0: 除外されている / 1: 除外されていない / 128: git の作業ツリーではない
+    return result.returncode != 0
+
+# -----------------------------------
+# 4. 保存・アップロード用関数
+# -----------------------------------
+# PDFチャートのPNG化解像度
+RENDER_DPI = 200
+
+@lru_cache(maxsize=None)
+def load_overlay_image(overlay_image_name, size):
+    """
+    レイヤー画像を読み込み、指定サイズに拡大縮小したRGBA画像を返す
+    同じレイヤー・同じサイズのチャート (aupq35/aupq78 など) では1回だけデコードする
+    レイヤー画像がない場合は None
+    """
+    from PIL import Image
+    overlay_png_path = os.path.join(layer_folder_path, overlay_image_name)
+    if not os.path.exists(overlay_png_path):
+        print(f"警告: レイヤー画像なし ({overlay_png_path}) -> 合成スキップ")
+        return None
+    with Image.open(overlay_png_path) as overlay:
+        return overlay.convert("RGBA").resize(size, Image.Resampling.LANCZOS)
+
+# -----------------------------------
+# ★追加: 出力エンコード (パレット化・zlib最適化・Web用縮小版)
+# -----------------------------------
+# 後処理の結果 (処理失敗時は False)
+OUTPUT_UPDATED = "updated"
+OUTPUT_UNCHANGED = "unchanged"
+
+# 画素が前回のPNGと同じなら書き込まない (内容が同じでもエンコード差で git の差分が出ないように)
+# 見出しの発表時刻だけが変わった再発表も同じとみなす (Chart.diff_mask)
+SKIP_UNCHANGED_PIXELS = True
+
+# 上位256色で画素のこの割合以上を占めるチャートはパレット画像 (8bit) にする
+PNG_PALETTE_COVERAGE = 0.995
+PNG_PALETTE_SCAN_COLORS = 65536
+# 上位256色以外の画素は最も近いパレットの色に置き換える。RGB の差がこれを超える画素があればパレット化しない
+PNG_PALETTE_MAX_ERROR = 32
+
+# index.html 用の縮小版 (images/web/<名前>-<幅>.<形式>)
+web_folder_name = "web"
+WEB_WIDTHS = (800, 1600)
+WEB_FORMATS = {
+    "avif": {"quality": 55, "speed": 8},
+    "webp": {"quality": 80, "method": 4},
+}
+
+def available_web_formats():
+    """
+    このPillowで書き出せる形式だけを返す (AVIF は libavif 付きのビルドのみ)
+    """
+    from PIL import features
+    return [fmt for fmt in WEB_FORMATS if features.check(fmt)]
+
+def web_variant_path(final_drive_name, width, fmt):
+    stem = os.path.splitext(final_drive_name)[0]
+    return os.path.join(dest_folder_path, web_folder_name, f"{stem}-{width}.{fmt}")
+
+def web_variants_deployed():
+    """
+    縮小版がページと一緒に公開されるか (されないなら作らず、index.html の <source> にも書かない)
+    """
+    return deployed_with_page(os.path.join(dest_folder_path, web_folder_name))
+
+def web_variants(final_drive_name):
+    """
+    作成済みの縮小版 {形式: [(幅, パス), ...]} (index.html の srcset 用)
+    公開されない縮小版は返さない (ブラウザは読めなかった <source> から <img> に戻らない)
+    """
+    if not web_variants_deployed():
+        return {}
+    variants = {}
+    for fmt in available_web_formats():
+        found = [(width, web_variant_path(final_drive_name, width, fmt)) for width in WEB_WIDTHS]
+        found = [(width, path) for width, path in found if os.path.exists(current_path(path))]
+        if found:
+            variants[fmt] = found
+    return variants
+
+def optimize_chart_image(img):
+    """
+    実質的に少ない色で描かれたチャートをパレット画像に変換する
+    パレットは出現数の上位256色そのもの (平均した色は作らない)。256色以下ならそのまま (可逆)、
+    上位256色で PNG_PALETTE_COVERAGE 以上を占めるなら、残りの画素を最も近いパレットの色に置き換える
+    (置き換えで RGB の差が PNG_PALETTE_MAX_ERROR を超える画素があれば、印刷品質を優先してパレット化しない)
+    """
+    import numpy as np
+    from PIL import Image
+    if img.mode == "RGBA" and img.getextrema()[3] == (255, 255):
+        img = img.convert("RGB")
+    if img.mode != "RGB":
+        return img
+    colors = img.getcolors(maxcolors=PNG_PALETTE_SCAN_COLORS)
+    if colors is None:
+        return img
+    colors.sort(reverse=True)
+    if len(colors) > 256:
+        covered = sum(count for count, _ in colors[:256])
+        if covered < PNG_PALETTE_COVERAGE * img.width * img.height:
+            return img
+
+    # 色の一覧 (出現数の多い順) のそれぞれのパレット番号: 上位256色は自分自身、残りは最も近い色
+    color_rgb = np.array([rgb for _, rgb in colors], dtype=np.int32)
+    palette = color_rgb[:256]
+    color_index = np.arange(len(color_rgb))
+    rare = color_rgb[256:]
+    for start in range(0, len(rare), 4096):
+        chunk = rare[start:start + 4096]
+        distance = sum((chunk[:, None, c] - palette[None, :, c]) ** 2 for c in range(3))
+        nearest = distance.argmin(axis=1)
+        if np.abs(chunk - palette[nearest]).max() > PNG_PALETTE_MAX_ERROR:
+            return img
+        color_index[256 + start:256 + start + len(chunk)] = nearest
+
+    # 画素を色のキー (0xRRGGBB) で色の一覧から引き、パレット番号の画像にする
+    pixels = np.asarray(img, dtype=np.int32)
+    keys = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    color_keys = (color_rgb[:, 0] << 16) | (color_rgb[:, 1] << 8) | color_rgb[:, 2]
+    order = np.argsort(color_keys)
+    indexes = color_index[order[np.searchsorted(color_keys[order], keys)]].astype(np.uint8)
+    out = Image.frombytes("P", img.size, indexes.tobytes())
+    out.putpalette(palette.astype(np.uint8).ravel().tobytes())
+    return out
+
+def write_web_variants(img, final_drive_name):
+    from PIL import Image
+    formats = available_web_formats()
+    if not formats or not web_variants_deployed():
+        return
+    rgb = img.convert("RGB")
+    os.makedirs(staged_path(os.path.join(dest_folder_path, web_folder_name)), exist_ok=True)
+    for width in WEB_WIDTHS:
+        if width >= rgb.width:
+            continue
+        resized = rgb.resize((width, round(rgb.height * width / rgb.width)), Image.Resampling.LANCZOS)
+        for fmt in formats:
+            resized.save(staged_path(web_variant_path(final_drive_name, width, fmt)), fmt.upper(), **WEB_FORMATS[fmt])
+
+# -----------------------------------
+# ★追加: 画素差分 (前回のPNGとの比較。見出しの発表時刻だけの違いは変化なしとみなす)
+# -----------------------------------
+# RGB の差の最大値がこれ以下の画素はパレット化・アンチエイリアスの揺れとみなす
+DIFF_THRESHOLD = 48
+# 変化した画素は DIFF_CELL 四方のマスに集計し、DIFF_MIN_CELL_PIXELS 未満のマスはノイズとして捨てる
+DIFF_CELL = 16
+DIFF_MIN_CELL_PIXELS = 4
+
+# 変化した領域を赤く示した確認用の画像を images/diff/<名前> に書く (--diff-overlay)
+diff_folder_name = "diff"
+DIFF_OVERLAY = False
+
+# changed_fraction: 変化したマスの割合 / regions: 変化した領域の外接矩形 (画素座標) のリスト
+# cells: マスごとの変化画素数 (2次元配列)
+ChartDiff = namedtuple("ChartDiff", ["changed_fraction", "regions", "cells"])
+
+def configure_render_worker(diff_overlay):
+    """
+    処理プールの子プロセスの初期化 (spawn なので親で変更した設定を引き継ぐ)
+    """
+    global DIFF_OVERLAY
+    DIFF_OVERLAY = diff_overlay
+
+def diff_mask_boxes(mask, size):
+    width, height = size
+    return [(round(l * width), round(t * height), round(r * width), round(b * height)) for l, t, r, b in mask]
+
+def changed_regions(cells):
+    """
+    変化したマスを上下左右斜めのつながりでまとめ、マス単位の外接矩形 (左, 上, 右, 下) を返す
+    """
+    import numpy as np
+    todo = set(zip(*np.nonzero(cells)))
+    regions = []
+    while todo:
+        stack = [todo.pop()]
+        rows, cols = [], []
+        while stack:
+            row, col = stack.pop()
+            rows.append(row)
+            cols.append(col)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    neighbor = (row + dr, col + dc)
+                    if neighbor in todo:
+                        todo.remove(neighbor)
+                        stack.append(neighbor)
+        regions.append((int(min(cols)), int(min(rows)), int(max(cols)) + 1, int(max(rows)) + 1))
+    regions.sort(key=lambda r: (r[1], r[0]))
+    return regions
+
+def diff_chart_pixels(old, new, mask=()):
+    """
+    2枚のチャートを比較する (サイズが違えば全体が変化したとみなす)
+    mask: 無視する領域 (Chart.diff_mask と同じ形式)
+    """
+    import numpy as np
+    from PIL import ImageChops
+    width, height = new.size
+    rows, cols = -(-height // DIFF_CELL), -(-width // DIFF_CELL)
+    if old.size != new.size:
+        return ChartDiff(1.0, [(0, 0, width, height)], np.full((rows, cols), DIFF_CELL * DIFF_CELL))
+
+    # 画素ごとの差は Pillow (C実装) で求め、しきい値・マスク・集計は NumPy で行う
+    delta = np.asarray(ImageChops.difference(old.convert("RGB"), new.convert("RGB")))
+    # (ndarray.max(axis=2) はチャネル方向の縮約が遅いため、チャネル同士の np.maximum で求める)
+    changed = np.maximum(np.maximum(delta[..., 0], delta[..., 1]), delta[..., 2]) > DIFF_THRESHOLD
+    for left, top, right, bottom in diff_mask_boxes(mask, new.size):
+        changed[top:bottom, left:right] = False
+    if not changed.any():
+        return ChartDiff(0.0, [], np.zeros((rows, cols), dtype=np.int64))
+
+    padded = np.zeros((rows * DIFF_CELL, cols * DIFF_CELL), dtype=bool)
+    padded[:height, :width] = changed
+    cells = padded.reshape(rows, DIFF_CELL, cols, DIFF_CELL).sum(axis=(1, 3))
+    cells[cells < DIFF_MIN_CELL_PIXELS] = 0
+    regions = [
+        (left * DIFF_CELL, top * DIFF_CELL, min(right * DIFF_CELL, width), min(bottom * DIFF_CELL, height))
+        for left, top, right, bottom in changed_regions(cells > 0)
+    ]
+    return ChartDiff(np.count_nonzero(cells) / cells.size, regions, cells)
+
+def diff_against_previous(path, img, mask=()):
+    """
+    保存済みのPNGと比較する (前回の出力がなければ None)
+    """
+    from PIL import Image
+    path = current_path(path)
+    if not os.path.exists(path):
+        return None
+    with Image.open(path) as old:
+        return diff_chart_pixels(old, img, mask)
+
+def write_diff_overlay(img, diff, final_drive_name, mask=()):
+    """
+    新しいチャートを薄くし、変化の多いマスほど濃い赤 (ヒートマップ) と領域の枠を重ねた画像を保存する
+    無視した見出しの領域は灰色の枠で示す
+    """
+    import numpy as np
+    from PIL import Image, ImageDraw
+    base = Image.blend(img.convert("RGB"), Image.new("RGB", img.size, "white"), 0.5)
+    density = np.minimum(diff.cells * (255 / (DIFF_CELL * DIFF_CELL)) * 4, 160).astype(np.uint8)
+    alpha = Image.fromarray(density, "L").resize(
+        (density.shape[1] * DIFF_CELL, density.shape[0] * DIFF_CELL), Image.Resampling.NEAREST
+    ).crop((0, 0) + img.size)
+    base.paste(Image.new("RGB", img.size, (255, 0, 0)), (0, 0), alpha)
+
+    draw = ImageDraw.Draw(base)
+    for box in diff_mask_boxes(mask, img.size):
+        draw.rectangle(box, outline=(128, 128, 128), width=3)
+    for left, top, right, bottom in diff.regions:
+        draw.rectangle((left, top, right - 1, bottom - 1), outline=(255, 0, 0), width=4)
+
+    diff_path = staged_path(os.path.join(dest_folder_path, diff_folder_name, final_drive_name))
+    os.makedirs(os.path.dirname(diff_path), exist_ok=True)
+    base.save(diff_path, "PNG", optimize=True)
+
+# -----------------------------------
+# ★追加: タイル分割 (Deep Zoom 形式。index.html では viewer.js が見えている範囲だけ読み込む)
+# -----------------------------------
+# images/tiles/<名前>.dzi            … 画像サイズ・タイル設定
+# images/tiles/<名前>_files/<段>/<列>_<行>.<形式>
+# images/tiles/<名前>_preview.<形式>  … 読み込み前に表示する小さな画像
+tiles_folder_name = "tiles"
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_PREVIEW_WIDTH = 480
+TILE_FORMATS = {
+    "webp": {"quality": 85, "method": 4},
+    "png": {"optimize": True},
+}
+
+def tile_format():
+    from PIL import features
+    return "webp" if features.check("webp") else "png"
+
+def tile_paths(final_drive_name):
+    """
+    (dzi のパス, タイルのフォルダ, プレビューのパス)
+    """
+    stem = os.path.splitext(final_drive_name)[0]
+    base = os.path.join(dest_folder_path, tiles_folder_name, stem)
+    return base + ".dzi", base + "_files", f"{base}_preview.{tile_format()}"
+
+def tiles_deployed():
+    """
+    タイルがページと一緒に公開されるか (されないならタイルは作らず、index.html からも参照しない)
+    """
+    return deployed_with_page(os.path.join(dest_folder_path, tiles_folder_name))
+
+def tiles_exist(final_drive_name):
+    dzi_path, _, preview_path = tile_paths(final_drive_name)
+    return os.path.exists(current_path(dzi_path)) and os.path.exists(current_path(preview_path))
+
+def write_tile_pyramid(img, final_drive_name):
+    """
+    チャートを Deep Zoom のタイル (段ごとに 1/2 に縮小) とプレビューに分割してステージングに保存する
+    チャートが更新されたときだけ呼ぶ (公開時にタイルのフォルダごと入れ替わる)
+    """
+    from PIL import Image
+    fmt = tile_format()
+    options = TILE_FORMATS[fmt]
+    dzi_path, files_dir, preview_path = map(staged_path, tile_paths(final_drive_name))
+    if os.path.isdir(files_dir):
+        shutil.rmtree(files_dir)
+    os.makedirs(files_dir)
+
+    level_img = img.convert("RGB")
+    width, height = level_img.size
+    max_level = (max(width, height) - 1).bit_length()  # ceil(log2(長辺))
+    for level in range(max_level, -1, -1):
+        level_dir = os.path.join(files_dir, str(level))
+        os.makedirs(level_dir)
+        lw, lh = level_img.size
+        for col in range((lw + TILE_SIZE - 1) // TILE_SIZE):
+            for row in range((lh + TILE_SIZE - 1) // TILE_SIZE):
+                left = max(col * TILE_SIZE - TILE_OVERLAP, 0)
+                top = max(row * TILE_SIZE - TILE_OVERLAP, 0)
+                right = min((col + 1) * TILE_SIZE + TILE_OVERLAP, lw)
+                bottom = min((row + 1) * TILE_SIZE + TILE_OVERLAP, lh)
+                tile = level_img.crop((left, top, right, bottom))
+                tile.save(os.path.join(level_dir, f"{col}_{row}.{fmt}"), fmt.upper(), **options)
+        if level > 0:
+            level_img = level_img.resize(((lw + 1) // 2, (lh + 1) // 2), Image.Resampling.LANCZOS)
+
+    rgb = img.convert("RGB")
+    preview_width = min(TILE_PREVIEW_WIDTH, rgb.width)
+    preview = rgb.resize((preview_width, round(rgb.height * preview_width / rgb.width)), Image.Resampling.LANCZOS)
+    preview.save(preview_path, fmt.upper(), **options)
+
+    # dzi は最後に書く (途中で失敗した場合は tiles_exist が False のまま)
+    with open(dzi_path, "w", encoding="utf-8") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{fmt}" '
+            f'Overlap="{TILE_OVERLAP}" TileSize="{TILE_SIZE}">\n'
+            f'  <Size Width="{width}" Height="{height}"/>\n'
+            '</Image>\n'
+        )
+
+def save_chart_png(img, final_drive_name, source_data=None, diff_mask=None, web_assets=True):
+    """
+    チャート画像を最適化してPNGをステージングに保存し、Web用の縮小版・タイルも作る
+    source_data: 元のPNGのバイト列 (再エンコードしても小さくならなければそのまま使う)
+    diff_mask: 差分で無視する領域 (省略時はレジストリの Chart.diff_mask)
+    web_assets: False なら縮小版・タイルを作らない (index.html に載せないバッチ取得の対象)
+    戻り値: OUTPUT_UPDATED / 見出し以外の画素が前回と同じなら OUTPUT_UNCHANGED
+    """
+    dest_path = os.path.join(dest_folder_path, final_drive_name)
+    img = optimize_chart_image(img)
+    if diff_mask is None:
+        chart = CHARTS_BY_OUTPUT.get(final_drive_name)
+        diff_mask = chart.diff_mask if chart else ()
+    mask = diff_mask
+    diff = diff_against_previous(dest_path, img, mask) if SKIP_UNCHANGED_PIXELS else None
+    if diff is not None and not diff.regions:
+        print(f"画素変化なし: {final_drive_name} -> 書き込みスキップ")
+        if web_assets and not web_variants(final_drive_name):
+            write_web_variants(img, final_drive_name)
+        if web_assets and tiles_deployed() and not tiles_exist(final_drive_name):
+            write_tile_pyramid(img, final_drive_name)
+        return OUTPUT_UNCHANGED
+
+    if diff is not None:
+        print(f"画素変化: {final_drive_name} -> {diff.changed_fraction:.1%} ({len(diff.regions)} 領域)")
+        if DIFF_OVERLAY:
+            write_diff_overlay(img, diff, final_drive_name, mask)
+
+    buffer = BytesIO()
+    img.save(buffer, "PNG", optimize=True)
+    data = buffer.getvalue()
+    if source_data and len(source_data) <= len(data):
+        data = source_data
+
+    os.makedirs(staged_path(dest_folder_path), exist_ok=True)
+    with open(staged_path(dest_path), "wb") as f:
+        f.write(data)
+    if web_assets:
+        write_web_variants(img, final_drive_name)
+        if tiles_deployed():
+            write_tile_pyramid(img, final_drive_name)
+    return OUTPUT_UPDATED
+
+def pdf_to_png_and_upload(pdf_data, final_drive_name, overlay_image_name=None, diff_mask=None, web_assets=True):
+    """
+    PDFのバイト列の1ページ目だけをメモリ上でPNG化し、レイヤー画像をビットマップに直接合成して保存する
+    (中間の *_COLOR.pdf や一時PNGは作らない)
+    """
+    from pdf2image import convert_from_bytes
+    from PIL import Image
+    if not pdf_data:
+        return False
+    pages = convert_from_bytes(pdf_data, dpi=RENDER_DPI, first_page=1, last_page=1)
+    img = pages[0]
+    if overlay_image_name:
+        overlay = load_overlay_image(overlay_image_name, img.size)
+        if overlay is not None:
+            print(f"カラー合成処理: {final_drive_name} + {overlay_image_name}")
+            img = Image.alpha_composite(img.convert("RGBA"), overlay).convert("RGB")
+
+    status = save_chart_png(img, final_drive_name, diff_mask=diff_mask, web_assets=web_assets)
+    print(f"Rendered {final_drive_name} ({len(pdf_data)} bytes PDF)")
+    return status
+
+def direct_png_upload(png_data, final_drive_name, diff_mask=None, web_assets=True):
+    from PIL import Image
+    if not png_data:
+        return False
+    with Image.open(BytesIO(png_data)) as src:
+        src.load()
+        status = save_chart_png(src, final_drive_name, png_data, diff_mask, web_assets)
+    print(f"Saved {final_drive_name} ({len(png_data)} bytes PNG)")
+    return status
+
+# -----------------------------------
+# 5. 取得ステージ (並列ダウンロード)
+# -----------------------------------
+def run_fetch_stage(jobs, on_result=None, max_workers=FETCH_MAX_WORKERS):
+    """
+    jobs: {チャート名: 引数なしの取得関数}
+    on_result: 各チャートの取得完了時に呼ばれる関数 on_result(チャート名, 取得結果)
+    戻り値: {チャート名: 取得結果 (失敗時は None)}
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn): name for name, fn in jobs.items()}
+        # 取得が終わったものから順に後段の処理へ回す
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print(f"取得エラー: {name} -> {e}")
+                results[name] = None
+            if on_result:
+                on_result(name, results[name])
+    return results
+
+# -----------------------------------
+# ★追加: 処理ステージ (PNG化・合成・リサンプルをプロセスプールで並列実行)
+# -----------------------------------
+# CPUの重い処理はチャートごとに独立しているため、コア数ぶんのプロセスに振り分ける
+RENDER_MAX_WORKERS = os.cpu_count() or 1
+
+_render_pool = None
+
+@contextmanager
+def render_pool(max_workers=RENDER_MAX_WORKERS):
+    """
+    with ブロックの間、run_render_job の処理をプロセスプールで実行する
+    取得ステージのスレッドと混在するため fork ではなく spawn で起動する
+    ブロックを抜けると全ジョブ (完了時のコールバックを含む) の終了を待つ
+    """
+    global _render_pool
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                             initializer=configure_render_worker, initargs=(DIFF_OVERLAY,)) as executor:
+        _render_pool = executor
+        try:
+            yield executor
+        finally:
+            _render_pool = None
+
+def run_in_worker(fn, *args):
+    """
+    処理プールの子プロセスで fn(*args) を実行し、(結果, 所要時間, この子プロセスのピークメモリ KB) を返す
+    所要時間は子プロセス内で計った fn 本体の時間 (プールの空き待ち・引数の転送を含まない)
+    ピークメモリは子プロセス自身と、その終了済みの子 (poppler) の大きい方
+    """
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    peak_kb = None
+    if resource is not None:
+        peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return result, elapsed, peak_kb
+
+def run_render_job(fn, *args, metrics_chart=None):
+    """
+    fn(*args) をプロセスプールで実行し Future を返す (プール外ではその場で実行)
+    fn はモジュール直下の関数とし、戻り値はビットマップではなくファイルパスや bool にする
+    (引数のバイト列はそのまま子プロセスへ送られる)
+    metrics_chart: 指定すると fn 本体の所要時間をこのチャートの処理時間として記録する
+    """
+    if _render_pool is not None:
+        def unpack(f):
+            result, elapsed, peak_kb = f.result()
+            run_metrics.record_worker_peak(peak_kb)
+            if metrics_chart:
+                run_metrics.record_render_time(metrics_chart, elapsed)
+            return result
+
+        return then(_render_pool.submit(run_in_worker, fn, *args), unpack)
+    future = Future()
+    start = time.perf_counter()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    if metrics_chart:
+        run_metrics.record_render_time(metrics_chart, time.perf_counter() - start)
+    return future
+
+def then(future, fn):
+    """
+    future の完了後に fn(future) を実行し、その戻り値を結果とする新しい Future を返す
+    (新しい Future を待てば fn の後始末・記録まで済んでいることが保証される)
+    """
+    chained = Future()
+
+    def callback(f):
+        try:
+            chained.set_result(fn(f))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(callback)
+    return chained
+
+def wait_result(result):
+    """
+    後処理関数の戻り値 (OUTPUT_* / False / Future / それらのリスト) を待ち、
+    いずれかの出力PNGが更新されていれば True
+    """
+    if isinstance(result, list):
+        return any([wait_result(r) for r in result])
+    if isinstance(result, Future):
+        result = result.result()
+    return result == OUTPUT_UPDATED
+
+def record_render_metrics(final_drive_name, start, future):
+    """
+    処理ジョブの結果と、投入から完了までの時間のうちプールを待った時間を記録する
+    (処理時間そのものは run_render_job が子プロセス内で計った値)
+    """
+    if future.exception():
+        result = f"error: {future.exception()}"
+    else:
+        result = future.result() or "failed"
+    run_metrics.record_render(final_drive_name, time.perf_counter() - start, result)
+
+# 公開中のPNGの元になったPDF (結合PDFのベクターモードで元のページをそのまま使う)
+chart_source_dir = os.path.join(cache_folder_path, "sources")
+
+def chart_source_path(final_drive_name):
+    return os.path.join(chart_source_dir, os.path.splitext(final_drive_name)[0] + ".pdf")
+
+def keep_chart_source(pdf_data, final_drive_name, replace=True):
+    """
+    元PDFのバイト列をステージングの chart_source_dir に書く (PNGと一緒に公開される)
+    replace=False なら既に残っている場合は置き換えない (見出し以外同じで PNG を更新しなかった場合)
+    """
+    dest = chart_source_path(final_drive_name)
+    if not replace and os.path.exists(current_path(dest)):
+        return
+    os.makedirs(staged_path(chart_source_dir), exist_ok=True)
+    with open(staged_path(dest), "wb") as f:
+        f.write(pdf_data)
+
+def process_pdf_chart(fetched, final_drive_name, overlay_image_name=None, diff_mask=None, web_assets=True):
+    """
+    PDFチャートの後処理 (取得したバイト列をPNG化 + カラー合成して保存)
+    戻り値: OUTPUT_* の Future (PNG化はプロセスプールで行う)。処理しなかった場合 False
+    """
+    if not fetched:
+        return False
+    # 元PDFと合成レイヤーが前回と同じなら、合成・PNG化・コピーをすべて省略する
+    source_key = f"{fetched.sha256}:{overlay_image_name or ''}"
+    if output_is_current(final_drive_name, source_key):
+        print(f"変更なし: {final_drive_name} -> スキップ")
+        run_metrics.record_cache("output_current", chart=final_drive_name)
+        run_metrics.record_render(final_drive_name, None, "cached")
+        keep_chart_source(fetched.content, final_drive_name, replace=False)
+        return False
+    start = time.perf_counter()
+    future = run_render_job(pdf_to_png_and_upload, fetched.content, final_drive_name, overlay_image_name, diff_mask, web_assets,
+                            metrics_chart=final_drive_name)
+
+    def on_rendered(f):
+        if not f.exception() and f.result():
+            keep_chart_source(fetched.content, final_drive_name, replace=f.result() == OUTPUT_UPDATED)
+        record_render_metrics(final_drive_name, start, f)
+        if f.result():
+            record_output(final_drive_name, source_key)
+        return f.result()
+
+    return then(future, on_rendered)
+
+def process_png_chart(fetched, final_drive_name, diff_mask=None, web_assets=True):
+    if not fetched:
+        return False
+    source_key = fetched.sha256
+    if output_is_current(final_drive_name, source_key):
+        print(f"変更なし: {final_drive_name} -> スキップ")
+        run_metrics.record_cache("output_current", chart=final_drive_name)
+        run_metrics.record_render(final_drive_name, None, "cached")
+        return False
+    start = time.perf_counter()
+    future = run_render_job(direct_png_upload, fetched.content, final_drive_name, diff_mask, web_assets,
+                            metrics_chart=final_drive_name)
+
+    def on_saved(f):
+        record_render_metrics(final_drive_name, start, f)
+        if f.result():
+            record_output(final_drive_name, source_key)
+        return f.result()
+
+    return then(future, on_saved)
+
+def process_chart(chart, fetched):
+    # 差分のマスクは引数で渡す (処理プールの子プロセスのレジストリにはバッチ取得の対象がないため)
+    # index.html に載るのはレジストリ (CHARTS) のチャートだけなので、縮小版・タイルはそれだけ作る
+    web_assets = chart in CHARTS
+    if chart.format == "pdf":
+        return process_pdf_chart(fetched, chart.output, chart.overlay, chart.diff_mask, web_assets)
+    return process_png_chart(fetched, chart.output, chart.diff_mask, web_assets)
+
+# ★追加: 縮小版・タイルの補完 (どの内容のPNGから作ったかを記録し、ない・古い場合は公開中のPNGから作り直す)
+# 公開されるサイトに含まれないもの (.gitignore で除外したフォルダ) は作らない
+web_assets_manifest_path = os.path.join(dest_folder_path, "web_assets.json")
+
+def build_web_assets(png_path, final_drive_name):
+    """
+    PNGファイルから縮小版・タイルだけをステージングに作る (処理プールの子プロセスで実行する)
+    """
+    from PIL import Image
+    with Image.open(png_path) as img:
+        img.load()
+        write_web_variants(img, final_drive_name)
+        if tiles_deployed():
+            write_tile_pyramid(img, final_drive_name)
+    return True
+
+def web_assets_complete(final_drive_name):
+    """
+    公開するもの (縮小版・タイル) がそろっているか (タイルは縮小版の後に書くので、あれば両方ある)
+    """
+    if tiles_deployed():
+        return tiles_exist(final_drive_name)
+    return bool(web_variants(final_drive_name)) or not web_variants_deployed()
+
+def ensure_web_assets(charts=CHARTS):
+    """
+    各チャートの縮小版・タイルが今のPNGから作ったものかを web_assets_manifest_path で確かめ、
+    今回の処理で作っていないもので、ない・古いものはPNGから作り直す
+    fetch_and_process_all の後、publish_outputs の前に呼ぶ (レジストリ外のバッチ取得の対象は作らない)
+    戻り値: 作り直したチャートの数
+    """
+    if not tiles_deployed() and not web_variants_deployed():
+        return 0
+    manifest = {}
+    if os.path.exists(web_assets_manifest_path):
+        try:
+            with open(web_assets_manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"縮小版・タイルの記録を読めません ({e}) -> すべて確認し直します")
+    new_manifest = dict(manifest)
+    jobs = []
+    for chart in charts:
+        png_path = current_path(os.path.join(dest_folder_path, chart.output))
+        if chart not in CHARTS or not os.path.exists(png_path):
+            continue
+        with open(png_path, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        new_manifest[chart.output] = sha256
+        # タイルの .dzi は縮小版の後に書くので、これがあれば両方そろっている
+        dzi_path = tile_paths(chart.output)[0]
+        if os.path.exists(staged_path(dzi_path)):
+            continue
+        if manifest.get(chart.output) == sha256 and web_assets_complete(chart.output):
+            continue
+        print(f"縮小版・タイルを作り直します: {chart.output}")
+        jobs.append((chart.output, run_render_job(build_web_assets, png_path, chart.output)))
+
+    rebuilt = 0
+    for name, future in jobs:
+        try:
+            future.result()
+            rebuilt += 1
+        except Exception as e:
+            print(f"縮小版・タイルの作成エラー: {name} -> {e}")
+            new_manifest.pop(name, None)
+    if new_manifest != manifest:
+        os.makedirs(staged_path(dest_folder_path), exist_ok=True)
+        with open(staged_path(web_assets_manifest_path), "w", encoding="utf-8") as f:
+            json.dump(new_manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    return rebuilt
+
+def fetch_and_process_all(charts=CHARTS):
+    """
+    全チャートを並列に取得し、取得できたものから順にPNG化する
+    (PNG化・合成は render_pool の中ならプロセスプールで並列実行)
+    戻り値: 出力PNGを更新したチャートの出力名のリスト (レジストリの順)
+    """
+    with _resolved_sources_lock:
+        _resolved_sources.clear()
+    pending = {}
+    charts_by_output = {chart.output: chart for chart in charts}
+
+    def on_result(name, result):
+        try:
+            pending[name] = process_chart(charts_by_output[name], result)
+        except Exception as e:
+            print(f"後処理エラー: {name} -> {e}")
+
+    def fetch_with_metrics(chart):
+        # 発表時刻の確認 (probe_seconds) と本文の取得 (fetch_seconds) は fetch_chart の中で分けて計る
+        with run_metrics.for_chart(chart.output):
+            return fetch_chart(chart)
+
+    jobs = {chart.output: (lambda chart=chart: fetch_with_metrics(chart)) for chart in charts}
+    with run_metrics.stage("fetch"):
+        run_fetch_stage(jobs, on_result=on_result)
+
+    updated_charts = []
+    with run_metrics.stage("render"):
+        for chart in charts:
+            if chart.output not in pending:
+                continue
+            try:
+                if wait_result(pending[chart.output]):
+                    updated_charts.append(chart.output)
+            except Exception as e:
+                print(f"後処理エラー: {chart.output} -> {e}")
+    return updated_charts
+
+# index.html のチャート一覧 (この印の間をレジストリから書き換える)
+index_html_path = "index.html"
+INDEX_CHARTS_BEGIN = "<!-- charts:begin -->"
+INDEX_CHARTS_END = "<!-- charts:end -->"
+
+def index_charts(charts=CHARTS):
+    """
+    index.html に並べる順 (Chart.index_order の順、番号のないものはその後にレジストリの順)
+    """
+    return sorted(charts, key=lambda chart: (chart.index_order is None, chart.index_order or 0))
+
+def update_index_html(path=index_html_path, charts=CHARTS):
+    """
+    index.html の画像一覧を Chart.index_order の順に書き換える (内容が同じなら書き込まない)
+    publish_outputs の後に呼ぶ (一覧は公開済みの縮小版・タイルを参照する)
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding="utf-8") as f:
+        html = f.read()
+    begin = html.find(INDEX_CHARTS_BEGIN)
+    end = html.find(INDEX_CHARTS_END)
+    if begin < 0 or end < begin:
+        print(f"警告: {path} にチャート一覧の印がありません -> 更新スキップ")
+        return False
+
+    lines = []
+    for chart in index_charts(charts):
+        variants = web_variants(chart.output)
+        if not variants:
+            picture = [f'<img src="{dest_folder_path}/{chart.output}" loading="lazy">']
+        else:
+            # 縮小版があれば <picture> で AVIF/WebP を出し分ける (元のPNGは印刷・非対応ブラウザ用)
+            picture = ["<picture>"]
+            for fmt, found in variants.items():
+                srcset = ", ".join(f"{path.replace(os.sep, '/')} {width}w" for width, path in found)
+                picture.append(f'  <source type="image/{fmt}" srcset="{srcset}" sizes="(max-width: 900px) 100vw, 900px">')
+            picture.append(f'  <img src="{dest_folder_path}/{chart.output}" loading="lazy">')
+            picture.append("</picture>")
+        if not (tiles_deployed() and tiles_exist(chart.output)):
+            lines.extend("  " + line for line in picture)
+            continue
+        # タイルがあれば viewer.js が画面に入ったときにズーム可能な表示へ差し替える
+        # 最初に読むのは小さなプレビューだけで、元の画像は <noscript> に入れて
+        # JavaScript が無効なとき・タイルを読めなかったとき (viewer.js が差し替える) だけ表示する
+        dzi_path, _, preview_path = tile_paths(chart.output)
+        preview_url = preview_path.replace(os.sep, "/")
+        lines.append(f'  <div class="chart-tiles" data-dzi="{dzi_path.replace(os.sep, "/")}" data-preview="{preview_url}">')
+        lines.append(f'    <img class="chart-preview" src="{preview_url}" loading="lazy" alt="">')
+        lines.append("    <noscript>")
+        lines.extend("      " + line for line in picture)
+        lines.append("    </noscript>")
+        lines.append("  </div>")
+    block = INDEX_CHARTS_BEGIN + "\n" + "\n".join(lines) + "\n  "
+    new_html = html[:begin] + block + html[end:]
+    if new_html == html:
+        return False
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(new_html)
+    os.replace(tmp_path, path)
+    print(f"{path} のチャート一覧を更新しました")
+    return True
+
+
+# -----------------------------------
+# 6. 全画像を1つのPDFにまとめる処理 (印刷品質重視・限界挑戦版)
+# -----------------------------------
+# "vector": PDFチャートは元のPDFのページ (+ レイヤー) をそのまま縮小配置し、PNGの製品だけ画像で埋め込む
+# "raster": 全ページを A4 300DPI の JPEG にする (従来の方式)
+COMBINED_PDF_MODES = ("vector", "raster")
+COMBINED_PDF_MODE = "vector"
+combined_pdf_name = "all_weather_charts.pdf"
+
+# A4 300DPI (印刷品質基準)
+A4_PORTRAIT_PX = (2480, 3508)
+A4_LANDSCAPE_PX = (3508, 2480)
+PDF_PAGE_DPI = 300
+PDF_JPEG_QUALITY = 85   # 85はサイズ効率が非常に高いです
+
+# ページごとのエンコード済みJPEGのキャッシュ (元PNGのハッシュ + 設定をキーにする)
+pdf_page_cache_dir = os.path.join(cache_folder_path, "pages")
+
+def render_pdf_page(img_path):
+    """
+    画像をA4キャンバスの中央に配置し、JPEGにエンコードしたファイルのパスを返す
+    元PNGが前回と同じならキャッシュ済みのJPEGをそのまま使う (リサンプル・再エンコードしない)
+    """
+    from PIL import Image
+    settings = f"{A4_PORTRAIT_PX}:{PDF_JPEG_QUALITY}"
+    key = hashlib.sha256(f"{file_sha256(img_path)}:{settings}".encode()).hexdigest()
+    page_path = os.path.join(pdf_page_cache_dir, f"{key}.jpg")
+    if os.path.exists(page_path):
+        return page_path
+
+    with Image.open(img_path) as src:
+        img = src.convert("RGB")
+    w, h = img.size
+    page_size = A4_LANDSCAPE_PX if w >= h else A4_PORTRAIT_PX
+
+    img_ratio = w / h
+    page_ratio = page_size[0] / page_size[1]
+
+    if img_ratio > page_ratio:
+        new_w = page_size[0]
+        new_h = int(new_w / img_ratio)
+    else:
+        new_h = page_size[1]
+        new_w = int(new_h * img_ratio)
+
+    resized_img = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+    del img
+    page = Image.new("RGB", page_size, (255, 255, 255))
+    offset = ((page_size[0] - new_w) // 2, (page_size[1] - new_h) // 2)
+    page.paste(resized_img, offset)
+    del resized_img
+
+    os.makedirs(pdf_page_cache_dir, exist_ok=True)
+    tmp_path = page_path + ".tmp"
+    page.save(
+        tmp_path, "JPEG",
+        quality=PDF_JPEG_QUALITY,
+        subsampling=0,        # 色のにじみを防止
+        optimize=True         # 圧縮の最適化を有効化
+    )
+    os.replace(tmp_path, page_path)
+    return page_path
+
+def write_jpeg_pdf(output_path, jpeg_paths, dpi=PDF_PAGE_DPI):
+    """
+    JPEGファイルを1ページずつPDFに書き出す (JPEGはDCTDecodeのままバイト単位でコピー)
+    メモリ上に保持するのはオブジェクトのオフセットだけ
+    """
+    from PIL import Image
+    offsets = {}
+    page_ids = []
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        def begin_obj(obj_id):
+            offsets[obj_id] = f.tell()
+            f.write(f"{obj_id} 0 obj\n".encode())
+
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        # 1: カタログ, 2: ページツリー (最後に書く), 3以降: 各ページ (ページ・画像・描画命令)
+        begin_obj(1)
+        f.write(b"<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+
+        for i, jpeg_path in enumerate(jpeg_paths):
+            page_id, image_id, content_id = 3 + i * 3, 4 + i * 3, 5 + i * 3
+            with Image.open(jpeg_path) as im:
+                px_w, px_h = im.size
+            pt_w, pt_h = px_w * 72 / dpi, px_h * 72 / dpi
+
+            begin_obj(page_id)
+            f.write((
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pt_w:.2f} {pt_h:.2f}] "
+                f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>\nendobj\n"
+            ).encode())
+
+            begin_obj(image_id)
+            f.write((
+                f"<< /Type /XObject /Subtype /Image /Width {px_w} /Height {px_h} "
+                f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+                f"/Length {os.path.getsize(jpeg_path)} >>\nstream\n"
+            ).encode())
+            with open(jpeg_path, "rb") as src:
+                shutil.copyfileobj(src, f)
+            f.write(b"\nendstream\nendobj\n")
+
+            content = f"q {pt_w:.2f} 0 0 {pt_h:.2f} 0 0 cm /Im0 Do Q".encode()
+            begin_obj(content_id)
+            f.write(f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream\nendobj\n")
+            page_ids.append(page_id)
+
+        begin_obj(2)
+        kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+        f.write(f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>\nendobj\n".encode())
+
+        xref_offset = f.tell()
+        size = max(offsets) + 1
+        f.write(f"xref\n0 {size}\n0000000000 65535 f \n".encode())
+        for obj_id in range(1, size):
+            f.write(f"{offsets[obj_id]:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+    os.replace(tmp_path, output_path)
+
+# A4 (ポイント)
+A4_PORTRAIT_PT = (595.28, 841.89)
+
+def fit_on_a4(width, height):
+    """
+    width x height (pt) の内容をA4 (縦横は内容に合わせる) の中央に収める
+    戻り値: (ページ幅, ページ高さ, 倍率, 左余白, 下余白)
+    """
+    page_w, page_h = A4_PORTRAIT_PT if width < height else A4_PORTRAIT_PT[::-1]
+    scale = min(page_w / width, page_h / height)
+    return page_w, page_h, scale, (page_w - width * scale) / 2, (page_h - height * scale) / 2
+
+def add_vector_page(writer, pdf_path, overlay_image_name=None):
+    """
+    元PDFの1ページ目にレイヤーを重ね、A4ページの中央に縮小して追加する
+    """
+    from pypdf import PdfReader, Transformation
+    page = PdfReader(pdf_path).pages[0]
+    if page.rotation:
+        # PNG化 (pdf2image) と同じ向きにするため、/Rotate を内容に反映してから重ねる
+        page.transfer_rotation_to_content()
+    if overlay_image_name:
+        overlay_png_path = os.path.join(layer_folder_path, overlay_image_name)
+        if os.path.exists(overlay_png_path):
+            merge_overlay_page(page, overlay_png_path)
+    box = page.mediabox
+    page_w, page_h, scale, left, bottom = fit_on_a4(float(box.width), float(box.height))
+    a4 = writer.add_blank_page(page_w, page_h)
+    a4.merge_transformed_page(page, (
+        Transformation()
+        .translate(-float(box.left), -float(box.bottom))
+        .scale(scale)
+        .translate(left, bottom)
+    ))
+    a4.compress_content_streams()
+
+def add_image_page(writer, img_path):
+    """
+    画像を元の解像度のまま (可逆圧縮で) A4ページの中央に縮小配置して追加する
+    """
+    from PIL import Image
+    from pypdf import PdfReader
+    canvas, ImageReader = import_reportlab()
+    with Image.open(img_path) as src:
+        w, h = src.size
+    page_w, page_h, scale, left, bottom = fit_on_a4(w, h)
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=(page_w, page_h))
+    can.drawImage(ImageReader(img_path), left, bottom, width=w * scale, height=h * scale, mask="auto")
+    can.save()
+    packet.seek(0)
+    writer.add_page(PdfReader(packet).pages[0])
+
+def create_vector_pdf(image_folder, output_path, charts=CHARTS):
+    """
+    PDFチャートは残しておいた元PDFから、それ以外 (PNG製品・元PDFがないもの) は出力PNGからページを作る
+    """
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for chart in charts:
+        img_path = current_path(os.path.join(image_folder, chart.output))
+        if not os.path.exists(img_path):
+            continue
+        source_path = current_path(chart_source_path(chart.output))
+        try:
+            if chart.format == "pdf" and os.path.exists(source_path):
+                add_vector_page(writer, source_path, chart.overlay)
+            else:
+                add_image_page(writer, img_path)
+        except Exception as e:
+            print(f"エラー: {chart.output} -> {e}")
+
+    if not writer.pages:
+        return False
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        writer.write(f)
+    os.replace(tmp_path, output_path)
+    return True
+
+def create_raster_pdf(image_folder, output_path, charts=CHARTS):
+    target_images = [chart.output for chart in charts]
+
+    # 各ページのリサンプル・エンコードはプロセスプールで並列に行い、結果はJPEGのパスで受け取る
+    # (ページ順は target_images の順のまま)
+    page_jobs = []
+    for img_name in target_images:
+        img_path = current_path(os.path.join(image_folder, img_name))
+        if os.path.exists(img_path):
+            page_jobs.append((img_name, run_render_job(render_pdf_page, img_path)))
+
+    page_paths = []
+    for img_name, future in page_jobs:
+        try:
+            page_paths.append(future.result())
+        except Exception as e:
+            print(f"エラー: {img_name} -> {e}")
+
+    if not page_paths:
+        return False
+    write_jpeg_pdf(output_path, page_paths)
+
+    # 今回使わなかったページのキャッシュを削除する (group ごとのPDFはレジストリ全体のページの一部)
+    if charts is CHARTS:
+        used = {os.path.basename(path) for path in page_paths}
+        for name in os.listdir(pdf_page_cache_dir):
+            if name not in used:
+                os.remove(os.path.join(pdf_page_cache_dir, name))
+    return True
+
+def create_combined_pdf(image_folder, output_pdf_name, mode=None, charts=CHARTS):
+    """
+    今回の実行で書いたチャート (なければ公開中のもの) を結合し、PDFはステージングに書く
+    """
+    mode = mode or COMBINED_PDF_MODE
+    output_path = staged_path(os.path.join(image_folder, output_pdf_name))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if mode == "vector":
+        print(f"--- A4 PDF結合開始 (元PDFのベクターのまま配置): {output_pdf_name} ---")
+        created = create_vector_pdf(image_folder, output_path, charts)
+    else:
+        print(f"--- A4高画質PDF結合開始 (300DPI・高品質設定): {output_pdf_name} ---")
+        created = create_raster_pdf(image_folder, output_path, charts)
+
+    if created:
+        file_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        print(f"PDF作成完了: {output_path} (サイズ: {file_size_mb:.2f} MB)")
+
+        # もしこれでも25MBを超えた場合の警告
+        if file_size_mb > 25:
+            print("【警告】ファイルサイズが25MBを超えています。Cloudflare Pagesでの公開に失敗する可能性があります。")
+    else:
+        print("作成対象の画像が見つかりませんでした。")
+
+# -----------------------------------
+# 7. メイン実行
+# -----------------------------------
+def group_pdf_name(group):
+    return f"{group}_charts.pdf"
+
+def create_group_pdfs(charts, updated_charts):
+    """
+    group ごとの結合PDF (images/<group>_charts.pdf) を、メンバーが更新された group だけ作り直す
+    PDFには今回処理した分だけでなく、登録済みの同じ group の全チャートを入れる (常駐モードで一部だけ処理した場合も)
+    """
+    for group in dict.fromkeys(chart.group for chart in charts if chart.group):
+        members = [chart for chart in CHARTS_BY_OUTPUT.values() if chart.group == group]
+        pdf_name = group_pdf_name(group)
+        if any(chart.output in updated_charts for chart in members) or \
+                not os.path.exists(current_path(os.path.join(dest_folder_path, pdf_name))):
+            create_combined_pdf(dest_folder_path, pdf_name, charts=members)
+
+def run_update(charts=CHARTS):
+    """
+    指定したチャートを取得・処理し、PDF結合・index.html・キャッシュ保存・実行レポートまで行う
+    (render_pool の中で呼ぶと処理を並列化する)
+    戻り値: 出力PNGを更新したチャートの出力名のリスト
+    """
+    os.makedirs(dest_folder_path, exist_ok=True)
+    print(f"Destination folder: {dest_folder_path}")
+    run_metrics.reset()
+    clear_staging()
+
+    updated_charts = fetch_and_process_all(charts)
+    with run_metrics.stage("web_assets"):
+        ensure_web_assets(charts)
+    with run_metrics.stage("archive"):
+        archive_outputs(updated_charts)
+
+    # どのチャートも変わっていなければPDFも作り直さない (git の差分を出さない)
+    # (レジストリ外のバッチ取得の対象は全体のPDFに入らないので、それだけの更新では作り直さない)
+    combined_pdf_path = os.path.join(dest_folder_path, combined_pdf_name)
+    registry_outputs = {chart.output for chart in CHARTS}
+    with run_metrics.stage("combined_pdf"):
+        if registry_outputs.intersection(updated_charts) or not os.path.exists(combined_pdf_path):
+            create_combined_pdf(dest_folder_path, combined_pdf_name)
+        else:
+            print("全チャート変更なし: PDF結合をスキップします")
+        create_group_pdfs(charts, updated_charts)
+
+    # PNG・タイル・PDFがそろってからまとめて公開し、その後で index.html を書き換える
+    with run_metrics.stage("publish"):
+        print(f"公開: {publish_outputs()} 件")
+
+    with run_metrics.stage("index_html"):
+        update_index_html()
+
+    with run_metrics.stage("save_caches"):
+        save_caches()
+        try:
+            prune_archive()
+        except (OSError, sqlite3.Error) as e:
+            print(f"アーカイブ整理エラー: {e}")
+
+    report = run_metrics.write_report(output_names=[chart.output for chart in CHARTS])
+    print_run_summary(report)
+    return updated_charts
+
+
+# -----------------------------------
+# ★追加: 常駐モード (製品ごとの発表サイクルに合わせて必要なものだけ処理)
+# -----------------------------------
+# 予想公開時刻からこれだけ待ってから取りに行く
+DAEMON_PUBLISH_MARGIN = timedelta(minutes=5)
+# 予想時刻に新しい発表が見つからなかった場合の再確認間隔
+DAEMON_RETRY_INTERVAL = timedelta(minutes=10)
+# 発表サイクルのない固定URLの製品を確認する間隔
+DAEMON_POLL_INTERVAL = timedelta(minutes=30)
+
+def next_publication(product, now_utc):
+    """
+    now_utc より後で最初に公開が見込まれる発表 (発表時刻, 取りに行く時刻) を返す
+    """
+    hours, lag = ISSUANCE_SCHEDULES[product]
+    day = now_utc.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    for i in range(3):
+        for h in sorted(hours):
+            issued = day + timedelta(days=i, hours=h)
+            due = issued + lag + DAEMON_PUBLISH_MARGIN
+            if due > now_utc:
+                return issued, due
+    raise ValueError(f"発表サイクルが空です: {product}")
+
+def schedule_next(chart, expected, now_utc):
+    """
+    処理したチャートの次回の (取りに行く時刻, 期待する発表時刻) を決める
+    期待した発表がまだ出ていなければ、次の発表までの間 DAEMON_RETRY_INTERVAL ごとに再確認する
+    """
+    if not chart.schedule:
+        return now_utc + DAEMON_POLL_INTERVAL, None
+    issued, due = next_publication(chart.schedule, now_utc)
+    # group のチャートは共有のキーと、共有の時刻に図がなく個別に推定し直した場合のキーの新しい方
+    with _resolved_sources_lock:
+        times = [_resolved_sources.get(resolver_key(chart, shared), {}).get("time") for shared in (True, False)]
+    times = [t for t in times if t]
+    resolved = max(times) if times else None
+    if expected and (resolved is None or resolved < expected):
+        retry = now_utc + DAEMON_RETRY_INTERVAL
+        if retry < due:
+            return retry, expected
+    return due, issued
+
+def run_daemon(on_update=None, charts=CHARTS):
+    """
+    常駐して、各製品を発表サイクルに合わせて取得する
+    HTTPセッション・処理プール (合成レイヤーのデコード結果) ・発表時刻の推定結果はメモリに保持したまま再利用する
+    on_update: チャートを更新したときに実行するシェルコマンド (例: git commit && git push)
+    """
+    now_utc = datetime.now(UTC)
+    # 起動直後は全製品を1回処理する
+    due = {chart.output: (now_utc, None) for chart in charts}
+    print(f"常駐モード開始: {len(charts)}製品")
+
+    with render_pool():
+        while True:
+            now_utc = datetime.now(UTC)
+            due_charts = [chart for chart in charts if due[chart.output][0] <= now_utc]
+            if due_charts:
+                print(f"--- {now_utc.isoformat()} 処理対象: {', '.join(chart.output for chart in due_charts)} ---")
+                try:
+                    updated_charts = run_update(due_charts)
+                    if updated_charts and on_update:
+                        result = subprocess.run(on_update, shell=True)
+                        if result.returncode != 0:
+                            print(f"更新後コマンドが失敗しました (終了コード {result.returncode})")
+                except Exception as e:
+                    print(f"実行エラー: {e}")
+                now_utc = datetime.now(UTC)
+                for chart in due_charts:
+                    due[chart.output] = schedule_next(chart, due[chart.output][1], now_utc)
+
+            wake = min(due_time for due_time, _ in due.values())
+            next_charts = [output for output, (due_time, _) in due.items() if due_time == wake]
+            print(f"次回: {wake.isoformat()} ({', '.join(next_charts)})")
+            time.sleep(max(1.0, (wake - datetime.now(UTC)).total_seconds()))
+
+# -----------------------------------
+# ★追加: バッチ取得 (複数の空港・火山をまとめて取得)
+# -----------------------------------
+def batch_charts(icao_codes=(), volcano_codes=()):
+    """
+    空港 (ICAO) ごとの TAF 図と火山ごとの降灰予報図のチャートを作り、レジストリに登録する
+    """
+    return register_charts(taf_charts(icao_codes) + ashfall_charts(volcano_codes))
+
+def run_batch(icao_codes=(), volcano_codes=()):
+    """
+    指定した空港・火山の図を1回でまとめて取得し、対象ごとのPNGと group ごとの結合PDFを作る
+    降灰予報の発表時刻は全火山で1回だけ推定し、取得は全対象を同時に行う
+    (render_pool の中で呼ぶと処理を並列化する)
+    戻り値: 出力PNGを更新したチャートの出力名のリスト
+    """
+    charts = batch_charts(icao_codes, volcano_codes)
+    print(f"バッチ取得: 空港 {len(icao_codes)} / 火山 {len(volcano_codes)} ({len(charts)}図)")
+    return run_update(charts)
+
+# -----------------------------------
+# ★追加: 部分実行 (チャートを指定した更新・結合PDFだけの作り直し・発表時刻の確認・過去の発表の一覧)
+# -----------------------------------
+def select_charts(names, charts=CHARTS):
+    """
+    名前に合うチャートをレジストリの順に返す
+    names: 出力名 (FXJP106_Latest.png) または製品名 (FXJP106, ASAS, QMCD_RJFK など。大文字小文字は区別しない)
+    合うチャートがない名前があれば ValueError
+    """
+    selected = set()
+    for name in names:
+        key = name.upper()
+        found = [chart for chart in charts if key in (chart.output.upper(), chart_product(chart).upper())]
+        if not found:
+            raise ValueError(f"該当するチャートがありません: {name}")
+        selected.update(found)
+    return [chart for chart in charts if chart in selected]
+
+def rebuild_pdfs():
+    """
+    公開中のPNG・元PDFから結合PDF (全体と group ごと) だけを作り直して公開する (取得・PNG化はしない)
+    """
+    clear_staging()
+    create_combined_pdf(dest_folder_path, combined_pdf_name)
+    create_group_pdfs(CHARTS, [chart.output for chart in CHARTS])
+    print(f"公開: {publish_outputs()} 件")
+
+def resolve_latest_times(charts=CHARTS):
+    """
+    各チャートの取得対象 (発表時刻とURL) を推定するだけで、取得・保存はしない (キャッシュも書き込まない)
+    戻り値: {出力名: (発表時刻, URL)}。発表サイクルのない製品の時刻は None、見つからなければ (None, None)
+    """
+    with _resolved_sources_lock:
+        _resolved_sources.clear()
+
+    def resolve(chart):
+        if not chart.schedule:
+            return None, chart.url
+        target_time = resolve_chart_time(chart)
+        if not target_time:
+            return None, None
+        target_time = previous_issuance(chart.schedule, target_time, chart.cycles_back)
+        return target_time, chart.url.format(t=target_time)
+
+    results = run_fetch_stage({chart.output: (lambda chart=chart: resolve(chart)) for chart in charts})
+    return {chart.output: results[chart.output] or (None, None) for chart in charts}
+
+def print_latest_times(times):
+    for output, (target_time, url) in times.items():
+        issued = target_time.strftime("%Y-%m-%d %H:%MZ") if target_time else "-"
+        print(f"{output:<32}{issued:<19}{url or '見つかりませんでした'}")
+
+def parse_utc_time(text):
+    """
+    コマンドラインの時刻 (ISO 形式。例: 2026-10-16T12:00) を datetime にする (タイムゾーンがなければ UTC)
+    """
+    dt = datetime.fromisoformat(text)
+    return dt if dt.tzinfo else dt.replace(tzinfo=UTC)
+
+def archive_history(products=None, last=10, since=None, until=None, at=None, kind=ARCHIVE_OUTPUT):
+    """
+    アーカイブに保存した発表を返す: [(製品名, 発表時刻, ファイルパス), ...]
+    at:    その発表時刻のものを製品ごとに1件 (products を省略するとアーカイブにある全製品)
+    since: since 以上 until (省略時は現在) 未満のものを製品ごとに古い順に
+    どちらもなければ製品ごとに新しい順に last 件
+    products を省略するとレジストリの全製品
+    """
+    if not os.path.exists(archive_index_path):
+        return []
+    if at:
+        found = archive_charts_valid_at(at, kind)
+        return [(product, at, found[product]) for product in (products or sorted(found)) if product in found]
+    entries = []
+    for product in products or dict.fromkeys(chart_product(chart) for chart in CHARTS):
+        if since:
+            issuances = archive_issuances_between(product, since, until or datetime.now(UTC), kind)
+        else:
+            issuances = archive_last_issuances(product, last, kind)
+        entries += [(product, valid_time, path) for valid_time, path in issuances]
+    return entries
+
+def print_archive_history(entries):
+    if not entries:
+        print("アーカイブに該当する発表がありません")
+    for product, valid_time, path in entries:
+        print(f"{product:<20}{valid_time.strftime('%Y-%m-%d %H:%MZ'):<19}{path}")
+
+def export_archive(entries, folder):
+    """
+    archive_history の発表を folder に <製品名>_<発表時刻>.<png|pdf> としてコピーする (ループ表示・前回との比較用)
+    戻り値: コピーした件数
+    """
+    os.makedirs(folder, exist_ok=True)
+    count = 0
+    for product, valid_time, path in entries:
+        if not os.path.exists(path):
+            print(f"アーカイブの本体がありません: {product} {valid_time.isoformat()}")
+            continue
+        with open(path, "rb") as f:
+            ext = "pdf" if f.read(4) == b"%PDF" else "png"
+        shutil.copyfile(path, os.path.join(folder, f"{product}_{valid_time.strftime('%Y%m%d%H%M')}.{ext}"))
+        count += 1
+    return count
+
+def main(argv=None):
+    global COMBINED_PDF_MODE
+    parser = argparse.ArgumentParser(description="JMA の天気図を取得して images/ に保存する")
+    parser.add_argument("--daemon", action="store_true", help="常駐して各製品の発表サイクルごとに取得する")
+    parser.add_argument("--on-update", help="常駐モードでチャートを更新したときに実行するシェルコマンド")
+    parser.add_argument("--diff-overlay", action="store_true",
+                        help=f"前回から変化した領域を示す画像を {dest_folder_path}/{diff_folder_name}/ に書き出す")
+    parser.add_argument("--pdf-mode", choices=COMBINED_PDF_MODES, default=COMBINED_PDF_MODE,
+                        help="結合PDFの作り方 (vector: 元PDFのページを配置 / raster: 300DPIのJPEG)")
+    parser.add_argument("--airports", nargs="+", default=[], metavar="ICAO",
+                        help="指定した空港の TAF 図 (QMCD/QMCJ) だけをまとめて取得する (例: RJFK RJTT)")
+    parser.add_argument("--volcanoes", nargs="+", default=[], metavar="CODE",
+                        help="指定した火山の降灰予報図だけをまとめて取得する (JMA の火山コード。例: JR506X)")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND", help="省略時は全チャートを更新する")
+    update_parser = subparsers.add_parser("update", help="指定したチャートだけ取得・更新する (例: update FXJP106)")
+    update_parser.add_argument("charts", nargs="+", metavar="CHART",
+                               help="出力名または製品名 (ASAS, FXJP106, QMCD_RJFK など)")
+    subparsers.add_parser("pdf", help="公開中のチャートから結合PDFだけを作り直す")
+    resolve_parser = subparsers.add_parser("resolve", help="最新の発表時刻とURLを確認するだけ (取得・保存はしない)")
+    resolve_parser.add_argument("charts", nargs="*", metavar="CHART", help="確認するチャート (省略時は全チャート)")
+    history_parser = subparsers.add_parser("history", help=f"{archive_folder_path}/ に保存した過去の発表を一覧・書き出す")
+    history_parser.add_argument("charts", nargs="*", metavar="CHART", help="対象のチャート (省略時は全チャート)")
+    history_parser.add_argument("--last", type=int, default=10, metavar="N", help="製品ごとに新しい順に N 件 (既定 10)")
+    history_parser.add_argument("--since", type=parse_utc_time, metavar="TIME",
+                                help="この時刻 (UTC) 以降の発表を古い順に (例: 2026-10-16T00:00)")
+    history_parser.add_argument("--until", type=parse_utc_time, metavar="TIME", help="--since の終わり (省略時は現在)")
+    history_parser.add_argument("--at", type=parse_utc_time, metavar="TIME", help="この発表時刻 (UTC) の図を製品ごとに")
+    history_parser.add_argument("--source", action="store_true",
+                                help="出力PNGではなく取得した元データを対象にする (ARCHIVE_KINDS に入れた場合だけ保存される)")
+    history_parser.add_argument("--export", metavar="DIR",
+                                help="一覧した発表を DIR に <製品名>_<発表時刻> の名前でコピーする (ループ表示・比較用)")
+    args = parser.parse_args(argv)
+    configure_render_worker(args.diff_overlay)
+    COMBINED_PDF_MODE = args.pdf_mode
+
+    charts = CHARTS
+    if args.command in ("update", "resolve", "history") and args.charts:
+        try:
+            charts = select_charts(args.charts)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.command == "resolve":
+        print_latest_times(resolve_latest_times(charts))
+        return
+    if args.command == "history":
+        entries = archive_history(
+            products=list(dict.fromkeys(chart_product(chart) for chart in charts)) if args.charts else None,
+            last=args.last, since=args.since, until=args.until, at=args.at,
+            kind=ARCHIVE_SOURCE if args.source else ARCHIVE_OUTPUT,
+        )
+        print_archive_history(entries)
+        if args.export:
+            print(f"書き出し: {export_archive(entries, args.export)} 件 -> {args.export}")
+        return
+    if args.command == "pdf":
+        # ベクター方式は処理プールを使わないので子プロセスを起動しない
+        with render_pool() if COMBINED_PDF_MODE == "raster" else nullcontext():
+            rebuild_pdfs()
+        return
+
+    if args.daemon:
+        try:
+            run_daemon(on_update=args.on_update)
+        except KeyboardInterrupt:
+            print("常駐モード終了")
+        return
+
+    # 1回だけ実行 (cron / GitHub Actions 用)
+    # 1製品だけの更新は処理プール (子プロセスの起動) を使わずにこのプロセスで処理する
+    with render_pool() if len(charts) > 1 or args.airports or args.volcanoes else nullcontext():
+        if args.airports or args.volcanoes:
+            run_batch(args.airports, args.volcanoes)
+        else:
+            run_update(charts)
 
-# 実行
-create_combined_pdf(dest_folder_path, "all_weather_charts.pdf")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+// チャートのズーム表示 (update_weather.py が書き出す Deep Zoom タイルを使う)
+// 画面に入ったチャートだけ初期化し、見えている範囲・表示倍率に合うタイルだけを読み込む
+(function () {
+  "use strict";
+
+  var MAX_ZOOM = 8;
+
+  function parseDzi(text) {
+    var doc = new DOMParser().parseFromString(text, "application/xml");
+    var image = doc.getElementsByTagName("Image")[0];
+    var size = doc.getElementsByTagName("Size")[0];
+    var width = parseInt(size.getAttribute("Width"), 10);
+    var height = parseInt(size.getAttribute("Height"), 10);
+    return {
+      format: image.getAttribute("Format"),
+      overlap: parseInt(image.getAttribute("Overlap"), 10),
+      tileSize: parseInt(image.getAttribute("TileSize"), 10),
+      width: width,
+      height: height,
+      maxLevel: Math.ceil(Math.log2(Math.max(width, height)))
+    };
+  }
+
+  function ChartViewer(container, dziUrl, info) {
+    this.info = info;
+    this.tilesUrl = dziUrl.replace(/\.dzi$/, "_files/");
+    this.zoom = 1;
+    this.level = -1;
+    this.tiles = {};
+    this.pending = false;
+
+    this.viewport = document.createElement("div");
+    this.viewport.className = "chart-viewport";
+    this.viewport.style.backgroundImage = "url(" + container.getAttribute("data-preview") + ")";
+    this.canvas = document.createElement("div");
+    this.canvas.className = "chart-canvas";
+    this.viewport.appendChild(this.canvas);
+
+    var controls = document.createElement("div");
+    controls.className = "chart-zoom";
+    controls.appendChild(this.button("+", 2));
+    controls.appendChild(this.button("−", 0.5));
+
+    container.innerHTML = "";
+    container.appendChild(controls);
+    container.appendChild(this.viewport);
+
+    var self = this;
+    this.viewport.addEventListener("scroll", function () { self.schedule(); });
+    window.addEventListener("resize", function () { self.layout(); });
+    this.layout();
+  }
+
+  ChartViewer.prototype.button = function (label, factor) {
+    var self = this;
+    var button = document.createElement("button");
+    button.type = "button";
+    button.textContent = label;
+    button.addEventListener("click", function () { self.setZoom(self.zoom * factor); });
+    return button;
+  };
+
+  // ズームしても表示中の中心がずれないようにスクロール位置を合わせる
+  ChartViewer.prototype.setZoom = function (zoom) {
+    zoom = Math.min(Math.max(zoom, 1), MAX_ZOOM);
+    if (zoom === this.zoom) {
+      return;
+    }
+    var vp = this.viewport;
+    var cx = (vp.scrollLeft + vp.clientWidth / 2) / this.canvas.offsetWidth;
+    var cy = (vp.scrollTop + vp.clientHeight / 2) / this.canvas.offsetHeight;
+    this.zoom = zoom;
+    this.layout();
+    vp.scrollLeft = cx * this.canvas.offsetWidth - vp.clientWidth / 2;
+    vp.scrollTop = cy * this.canvas.offsetHeight - vp.clientHeight / 2;
+    this.render();
+  };
+
+  ChartViewer.prototype.layout = function () {
+    var width = this.viewport.clientWidth;
+    var height = Math.round(width * this.info.height / this.info.width);
+    this.viewport.style.height = height + "px";
+    this.canvas.style.width = Math.round(width * this.zoom) + "px";
+    this.canvas.style.height = Math.round(height * this.zoom) + "px";
+    // 拡大中はプレビューが粗く見えるだけなので背景に出さない
+    this.viewport.style.backgroundSize = this.zoom === 1 ? "100% 100%" : "0 0";
+    this.render();
+  };
+
+  ChartViewer.prototype.schedule = function () {
+    var self = this;
+    if (this.pending) {
+      return;
+    }
+    this.pending = true;
+    window.requestAnimationFrame(function () {
+      self.pending = false;
+      self.render();
+    });
+  };
+
+  ChartViewer.prototype.render = function () {
+    var info = this.info;
+    var canvasWidth = this.canvas.offsetWidth;
+    if (!canvasWidth) {
+      return;
+    }
+    // 表示幅 x devicePixelRatio を満たす一番小さい段を選ぶ
+    var scale = canvasWidth * (window.devicePixelRatio || 1) / info.width;
+    var level = Math.min(Math.max(Math.ceil(info.maxLevel + Math.log2(scale)), 0), info.maxLevel);
+    if (level !== this.level) {
+      this.level = level;
+      this.tiles = {};
+      this.canvas.innerHTML = "";
+    }
+
+    var factor = Math.pow(2, info.maxLevel - level);
+    var levelWidth = Math.ceil(info.width / factor);
+    var levelHeight = Math.ceil(info.height / factor);
+    var px = canvasWidth / levelWidth;
+    var size = info.tileSize;
+    var overlap = info.overlap;
+
+    var vp = this.viewport;
+    var firstCol = Math.max(Math.floor(vp.scrollLeft / px / size), 0);
+    var lastCol = Math.min(Math.floor((vp.scrollLeft + vp.clientWidth) / px / size), Math.ceil(levelWidth / size) - 1);
+    var firstRow = Math.max(Math.floor(vp.scrollTop / px / size), 0);
+    var lastRow = Math.min(Math.floor((vp.scrollTop + vp.clientHeight) / px / size), Math.ceil(levelHeight / size) - 1);
+
+    for (var col = firstCol; col <= lastCol; col++) {
+      for (var row = firstRow; row <= lastRow; row++) {
+        var key = col + "_" + row;
+        if (this.tiles[key]) {
+          continue;
+        }
+        var left = Math.max(col * size - overlap, 0);
+        var top = Math.max(row * size - overlap, 0);
+        var right = Math.min((col + 1) * size + overlap, levelWidth);
+        var bottom = Math.min((row + 1) * size + overlap, levelHeight);
+        var tile = document.createElement("img");
+        tile.alt = "";
+        tile.style.left = left * px + "px";
+        tile.style.top = top * px + "px";
+        tile.style.width = (right - left) * px + "px";
+        tile.style.height = (bottom - top) * px + "px";
+        tile.src = this.tilesUrl + level + "/" + key + "." + info.format;
+        this.canvas.appendChild(tile);
+        this.tiles[key] = tile;
+      }
+    }
+  };
+
+  // タイルを表示できないときは <noscript> に入れてある元の画像に差し替える
+  function showFallback(container) {
+    var noscript = container.querySelector("noscript");
+    if (noscript) {
+      container.innerHTML = noscript.textContent;
+    }
+  }
+
+  function init(container) {
+    var dziUrl = container.getAttribute("data-dzi");
+    fetch(dziUrl)
+      .then(function (response) {
+        if (!response.ok) {
+          throw new Error(dziUrl + ": " + response.status);
+        }
+        return response.text();
+      })
+      .then(function (text) {
+        new ChartViewer(container, dziUrl, parseDzi(text));
+      })
+      .catch(function (error) {
+        console.warn(error);
+        showFallback(container);
+      });
+  }
+
+  function start() {
+    var containers = document.querySelectorAll(".chart-tiles[data-dzi]");
+    if (!("IntersectionObserver" in window) || !window.fetch) {
+      Array.prototype.forEach.call(containers, showFallback);
+      return;
+    }
+    var observer = new IntersectionObserver(function (entries) {
+      entries.forEach(function (entry) {
+        if (entry.isIntersecting) {
+          observer.unobserve(entry.target);
+          init(entry.target);
+        }
+      });
+    }, { rootMargin: "200px 0px" });
+    Array.prototype.forEach.call(containers, function (container) {
+      observer.observe(container);
+    });
+  }
+
+  if (document.readyState === "loading") {
+    document.addEventListener("DOMContentLoaded", start);
+  } else {
+    start();
+  }
+})();